@@ -2,11 +2,13 @@ import datetime
 from calendar import monthrange
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from telegram.ext import ContextTypes
-from utils import t, build_tracking_settings_keyboard
+from utils import t, build_tracking_settings_keyboard, keyboard_cache
 from search import process_selected_dates
 
 MAX_MONTHS_FORWARD = 12
 
+_BLANK = InlineKeyboardButton(" ", callback_data="noop")
+
 async def show_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = context.user_data.get("lang", "ru")
     markup = build_calendar_markup(context.user_data['calendar'], lang)
@@ -15,41 +17,73 @@ async def show_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif update.callback_query:
         await update.callback_query.edit_message_text(t("choose_dates", lang), reply_markup=markup)
 
-def build_calendar_markup(data, lang="ru"):
-    now = datetime.datetime.now()
-    target_month = now.month + data.get('month_offset', 0)
-    target_year = now.year + (target_month - 1) // 12
-    target_month = ((target_month - 1) % 12) + 1
-    _, days_in_month = monthrange(target_year, target_month)
-    keyboard = []
-    month_name = t(f"months_{target_month - 1}", lang)
-    calendar_title = t("calendar_title", lang, month=month_name, year=target_year)
-    keyboard.append([InlineKeyboardButton(calendar_title, callback_data="noop")])
-    day_labels = [t(f"weekdays_{i}", lang) for i in range(7)]
-    keyboard.append([InlineKeyboardButton(day, callback_data="noop") for day in day_labels])
-    first_day_weekday = datetime.date(target_year, target_month, 1).weekday()
-    week = [InlineKeyboardButton(" ", callback_data="noop")] * first_day_weekday
+def calendar_month(offset, today=None):
+    today = today or datetime.date.today()
+    month = today.month + offset
+    return today.year + (month - 1) // 12, (month - 1) % 12 + 1
+
+def parse_calendar_date(day_str):
+    return datetime.datetime.strptime(day_str, "%d-%m-%Y").date()
+
+def selected_dates(data):
+    selected = data.get('selected')
+    if not isinstance(selected, set):
+        selected = data['selected'] = set(selected or ())
+    return selected
+
+def _build_month_skeleton(year, month, lang, offset):
+    blank = (None, _BLANK, _BLANK)
+    month_name = t(f"months_{month - 1}", lang)
+    header = (
+        [InlineKeyboardButton(t("calendar_title", lang, month=month_name, year=year), callback_data="noop")],
+        [InlineKeyboardButton(t(f"weekdays_{i}", lang), callback_data="noop") for i in range(7)],
+    )
+    _, days_in_month = monthrange(year, month)
+    week = [blank] * datetime.date(year, month, 1).weekday()
+    weeks = []
     for day in range(1, days_in_month + 1):
-        day_str = f"{day:02d}-{target_month:02d}-{target_year}"
-        is_selected = day_str in data.get('selected', [])
-        label = f"[{day}]" if is_selected else str(day)
-        week.append(InlineKeyboardButton(label, callback_data=f"cal:{day_str}"))
+        day_str = f"{day:02d}-{month:02d}-{year}"
+        callback_data = f"cal:{day_str}"
+        week.append((
+            day_str,
+            InlineKeyboardButton(str(day), callback_data=callback_data),
+            InlineKeyboardButton(f"[{day}]", callback_data=callback_data),
+        ))
         if len(week) == 7:
-            keyboard.append(week)
+            weeks.append(tuple(week))
             week = []
     if week:
-        week += [InlineKeyboardButton(" ", callback_data="noop")] * (7 - len(week))
-        keyboard.append(week)
+        weeks.append(tuple(week + [blank] * (7 - len(week))))
     nav_buttons = []
-    if data.get('month_offset', 0) > 0:
+    if offset > 0:
         nav_buttons.append(InlineKeyboardButton("⬅️", callback_data="prev_month"))
-    if data.get('month_offset', 0) < MAX_MONTHS_FORWARD - 1:
+    if offset < MAX_MONTHS_FORWARD - 1:
         nav_buttons.append(InlineKeyboardButton("➡️", callback_data="next_month"))
-    keyboard.append(nav_buttons)
-    keyboard.append([
-        InlineKeyboardButton(t("calendar_done", lang), callback_data="calendar_done"),
-        InlineKeyboardButton(t("calendar_clear", lang), callback_data="calendar_clear")
-    ])
+    footer = (
+        nav_buttons,
+        [
+            InlineKeyboardButton(t("calendar_done", lang), callback_data="calendar_done"),
+            InlineKeyboardButton(t("calendar_clear", lang), callback_data="calendar_clear")
+        ],
+    )
+    return header, tuple(weeks), footer
+
+def get_month_skeleton(year, month, lang, offset):
+    key = ("calendar", year, month, lang, offset)
+    skeleton = keyboard_cache.get(key)
+    if skeleton is None:
+        skeleton = _build_month_skeleton(year, month, lang, offset)
+        keyboard_cache.set(key, skeleton)
+    return skeleton
+
+def build_calendar_markup(data, lang="ru"):
+    offset = data.get('month_offset', 0)
+    header, weeks, footer = get_month_skeleton(*calendar_month(offset), lang, offset)
+    selected = selected_dates(data)
+    keyboard = [*header]
+    for week in weeks:
+        keyboard.append([marked if day_str in selected else plain for day_str, plain, marked in week])
+    keyboard.extend(footer)
     return InlineKeyboardMarkup(keyboard)
 
 async def calendar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -60,38 +94,38 @@ async def calendar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not data:
         await query.edit_message_text(t("calendar_no_route", lang))
         return
+    selected = selected_dates(data)
     if query.data.startswith("cal:"):
         date = query.data[4:]
-        if date in data.get('selected', []):
-            data['selected'].remove(date)
+        if date in selected:
+            selected.discard(date)
         else:
-            data['selected'].append(date)
+            selected.add(date)
     elif query.data == "next_month":
         data['month_offset'] = data.get('month_offset', 0) + 1
     elif query.data == "prev_month":
         data['month_offset'] = data.get('month_offset', 0) - 1
     elif query.data == "calendar_clear":
-        data['selected'] = []
+        selected.clear()
     elif query.data == "calendar_done":
         past_dates = []
         today = datetime.date.today()
-        for d in list(data.get('selected', [])):
+        for d in selected:
             try:
-                parsed = datetime.datetime.strptime(d, "%d-%m-%Y").date()
-                if parsed < today:
+                if parse_calendar_date(d) < today:
                     past_dates.append(d)
-            except Exception:
+            except ValueError:
                 continue
         if past_dates:
-            data['selected'] = [d for d in data['selected'] if d not in past_dates]
-            formatted = ", ".join(past_dates)
+            selected.difference_update(past_dates)
+            formatted = ", ".join(sorted(past_dates, key=parse_calendar_date))
             combined_text = f"{t('past_date', lang)}: {formatted}\n\n{t('choose_dates', lang)}"
             markup = build_calendar_markup(data, lang)
             await query.edit_message_text(combined_text, reply_markup=markup)
             return
         if context.user_data.get("calendar_mode") == "track":
             context.user_data.setdefault("track", {})
-            context.user_data["track"]["selected_dates"] = data.get("selected", [])
+            context.user_data["track"]["selected_dates"] = sorted(selected, key=parse_calendar_date)
             await query.edit_message_text(
                 t("track_prompt_dates", lang),
                 reply_markup=build_tracking_settings_keyboard(lang)
@@ -0,0 +1,50 @@
+import logging
+import datetime
+from db import AsyncSessionLocal
+from models import CityCode
+from cache import LRUCache, MISSING
+
+IATA_TTL = datetime.timedelta(days=30)
+IATA_NEGATIVE_TTL = datetime.timedelta(hours=6)
+IATA_LRU_SIZE = 5000
+
+iata_lru = LRUCache(maxsize=IATA_LRU_SIZE)
+db_stats = {"hits": 0, "misses": 0, "writes": 0}
+
+def normalize_city_name(city_name: str) -> str:
+    return " ".join(city_name.strip().lower().replace("ё", "е").split())
+
+def _ttl_for(code):
+    return IATA_TTL if code else IATA_NEGATIVE_TTL
+
+async def lookup_cached_code(city_name: str):
+    key = normalize_city_name(city_name)
+    code = iata_lru.get(key, MISSING)
+    if code is not MISSING:
+        return True, code
+    async with AsyncSessionLocal() as session:
+        entry = await session.get(CityCode, key)
+    if entry:
+        age = datetime.datetime.utcnow() - entry.updated_at
+        remaining = _ttl_for(entry.code) - age
+        if remaining.total_seconds() > 0:
+            db_stats["hits"] += 1
+            iata_lru.set(key, entry.code, ttl=remaining.total_seconds())
+            return True, entry.code
+    db_stats["misses"] += 1
+    return False, None
+
+async def store_cached_code(city_name: str, code):
+    key = normalize_city_name(city_name)
+    iata_lru.set(key, code, ttl=_ttl_for(code).total_seconds())
+    async with AsyncSessionLocal() as session:
+        try:
+            await session.merge(CityCode(name=key, code=code, updated_at=datetime.datetime.utcnow()))
+            await session.commit()
+            db_stats["writes"] += 1
+        except Exception as e:
+            await session.rollback()
+            logging.warning(f"❗ Не удалось сохранить IATA-код для {key}: {e}")
+
+def city_cache_stats():
+    return {"lru": iata_lru.stats(), "db": dict(db_stats)}
@@ -0,0 +1,142 @@
+import os
+import json
+import logging
+
+CITIES_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cities.json')
+
+PREPOSITIONS = {"в", "во", "из", "изо", "до", "на", "к", "ко", "от", "с", "со", "по", "in", "to", "from"}
+CASE_ENDINGS = sorted([
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ой", "ей", "ом", "ем", "ах", "ях", "ую", "юю", "ая", "яя", "ые", "ие", "ый", "ий", "ых", "их",
+    "ы", "и", "а", "я", "е", "у", "ю", "о", "ь", "й",
+], key=len, reverse=True)
+MIN_STEM_LENGTH = 2
+FUZZY_MIN_LENGTH = 6
+FUZZY_MAX_DISTANCE = 1
+
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s",
+    "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+
+_END = ""
+
+def strip_prepositions(words):
+    return [w for w in words if w not in PREPOSITIONS]
+
+def normalize_city_query(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = "".join(ch if ch.isalnum() else " " for ch in text)
+    words = text.split()
+    if len(words) > 1:
+        words = strip_prepositions(words) or words
+    return " ".join(words)
+
+def transliterate(text: str) -> str:
+    return "".join(TRANSLIT.get(ch, ch) for ch in text)
+
+def _stem_word(word: str) -> str:
+    if not ("а" <= word[0] <= "я"):
+        return word
+    for ending in CASE_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+def stem_city_name(normalized: str) -> str:
+    return " ".join(_stem_word(w) for w in normalized.split())
+
+def _max_distance(word: str) -> int:
+    return FUZZY_MAX_DISTANCE if len(word) >= FUZZY_MIN_LENGTH else 0
+
+class CityIndex:
+    def __init__(self):
+        self._exact = {}
+        self._stems = {}
+        self._trie = {}
+        self.names = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, code, name_ru, name_en=None, aliases=()):
+        code = code.upper()
+        self.names.setdefault(code, {"name_ru": name_ru, "name_en": name_en})
+        for raw in (name_ru, name_en, *aliases):
+            if not raw:
+                continue
+            key = normalize_city_query(raw)
+            for variant in {key, transliterate(key)}:
+                self._exact.setdefault(variant, code)
+                self._stems.setdefault(stem_city_name(variant), code)
+                self._insert(variant, code)
+
+    def _insert(self, key, code):
+        node = self._trie
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node.setdefault(_END, code)
+
+    def resolve(self, text: str):
+        key = normalize_city_query(text)
+        if not key:
+            return None
+        code = self._exact.get(key)
+        if code:
+            return code
+        return self._stems.get(stem_city_name(key))
+
+    def fuzzy(self, text: str, max_distance=None):
+        key = normalize_city_query(text)
+        if max_distance is None:
+            max_distance = _max_distance(key)
+        if max_distance <= 0:
+            return None
+        best_codes, best_distance = set(), max_distance + 1
+        first_row = list(range(len(key) + 1))
+        stack = [(child, ch, first_row) for ch, child in self._trie.items() if ch != _END]
+        while stack:
+            node, ch, prev_row = stack.pop()
+            row = [prev_row[0] + 1]
+            for i in range(1, len(key) + 1):
+                row.append(min(
+                    row[i - 1] + 1,
+                    prev_row[i] + 1,
+                    prev_row[i - 1] + (key[i - 1] != ch)
+                ))
+            if _END in node and row[-1] <= best_distance:
+                if row[-1] < best_distance:
+                    best_codes, best_distance = set(), row[-1]
+                best_codes.add(node[_END])
+            if min(row) <= best_distance:
+                stack.extend((child, next_ch, row) for next_ch, child in node.items() if next_ch != _END)
+        return best_codes.pop() if len(best_codes) == 1 else None
+
+def load_city_index(path=CITIES_DATASET) -> CityIndex:
+    index = CityIndex()
+    try:
+        with open(path, encoding="utf-8") as f:
+            rows = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"❗ Не удалось загрузить справочник городов {path}: {e}")
+        return index
+    for row in rows:
+        index.add(row["code"], row.get("name_ru"), row.get("name_en"), row.get("aliases", ()))
+    logging.info(f"🗺 Загружено городов в офлайн-индекс: {len(index)}")
+    return index
+
+_city_index = None
+
+def get_city_index() -> CityIndex:
+    global _city_index
+    if _city_index is None:
+        _city_index = load_city_index()
+    return _city_index
+
+def resolve_city_offline(city_name: str):
+    return get_city_index().resolve(city_name)
+
+def fuzzy_city_offline(city_name: str):
+    return get_city_index().fuzzy(city_name)
@@ -1,9 +1,75 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select
 from sqlalchemy.orm import sessionmaker
-from models import Base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from models import Base, User
 
-engine = create_engine('sqlite:///aviabot.db', echo=False)
+DATABASE_URL = 'sqlite:///aviabot.db'
+ASYNC_DATABASE_URL = 'sqlite+aiosqlite:///aviabot.db'
+SQLITE_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64000,
+    "temp_store": "MEMORY",
+}
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas=SQLITE_PRAGMAS):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def create_db_engine(url=DATABASE_URL, pragmas=SQLITE_PRAGMAS):
+    engine = create_engine(
+        url,
+        echo=False,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        connect_args={"check_same_thread": False, "timeout": pragmas.get("busy_timeout", 5000) / 1000}
+    )
+    event.listen(engine, "connect", lambda dbapi_connection, _: apply_sqlite_pragmas(dbapi_connection, pragmas))
+    return engine
+
+def create_async_db_engine(url=ASYNC_DATABASE_URL, pragmas=SQLITE_PRAGMAS):
+    engine = create_async_engine(
+        url,
+        echo=False,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        connect_args={"timeout": pragmas.get("busy_timeout", 5000) / 1000}
+    )
+    event.listen(engine.sync_engine, "connect", lambda dbapi_connection, _: apply_sqlite_pragmas(dbapi_connection, pragmas))
+    return engine
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_db_engine()
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def fetch_user(session, telegram_id):
+    result = await session.execute(select(User).filter_by(telegram_id=telegram_id))
+    return result.scalars().first()
+
+async def upsert_user(telegram_id, defaults=None, **fields):
+    async with AsyncSessionLocal() as session:
+        user = await fetch_user(session, telegram_id)
+        if user is None:
+            user = User(telegram_id=telegram_id, **{**(defaults or {}), **fields})
+            session.add(user)
+        else:
+            for name, value in fields.items():
+                setattr(user, name, value)
+        await session.commit()
+        return user
+
+async def dispose_async_engine():
+    await async_engine.dispose()
 
 def init_db():
+    from migrations import run_migrations
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
@@ -1,17 +1,29 @@
+import time
+_import_started = time.perf_counter()
 import logging
 import nest_asyncio
 import asyncio
 import datetime
-import pytz
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from db import init_db, SessionLocal
-from models import User, Currency, Feedback, SearchHistory
-from sqlalchemy.orm import joinedload
-from utils import t, plural_passenger, build_filter_markup, build_currency_inline_keyboard, build_tracking_settings_keyboard, API_TOKEN, fill_airlines, fill_currencies, fill_translations
-from search import get_iata_code, get_ticket_price, save_search_and_results
-from tracking import track_command, track_callback, my_tracks, all_tracks, untrack_callback, check_prices_for_all
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
+from db import init_db, AsyncSessionLocal, dispose_async_engine
+from reference_data import get_registry, load_airlines_file
+from user_cache import get_profile, update_profile, profile_cache_stats
+from models import Feedback, SearchHistory
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from utils import t, plural_passenger, build_filter_markup, build_currency_inline_keyboard, build_tracking_settings_keyboard, API_TOKEN, fill_airlines, fill_currencies, fill_translations, get_translation_catalog, warm_keyboards
+from search import get_iata_code, search_with_fallback, render_ticket_reply, save_search_and_results, get_user_id, quote_cache_stats
+from tracking import track_command, track_callback, my_tracks, all_tracks, untrack_callback
 from calendar_utils import calendar_callback, show_calendar
+from tp_client import close_client, client_stats
+from notifier import start_dispatcher, stop_dispatcher, dispatcher_stats
+from persistence import SQLitePersistence
+from session_state import StateLifecycleManager, STATE_SWEEP_INTERVAL
+from city_index import strip_prepositions, get_city_index
+from city_cache import city_cache_stats
+
+IMPORT_DURATION = time.perf_counter() - _import_started
 
 logging.basicConfig(level=logging.INFO)
 nest_asyncio.apply()
@@ -36,20 +48,7 @@ async def language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = query.data.split(":")[1]
     context.user_data["lang"] = lang
     await query.edit_message_text(t("language_set", lang))
-    session = SessionLocal()
-    telegram_id = query.from_user.id
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if not user:
-        user = User(
-            telegram_id=telegram_id,
-            language=lang,
-            currency="RUB" if lang == "ru" else "USD"
-        )
-        session.add(user)
-    else:
-        user.language = lang
-    session.commit()
-    session.close()
+    await update_profile(query.from_user.id, defaults={"currency": "RUB" if lang == "ru" else "USD"}, language=lang)
     await choose_currency(update, context)
 
 async def choose_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -62,29 +61,14 @@ async def currency_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = context.user_data.get("lang", "ru")
     if query.data.startswith("currency:"):
         code = query.data.split(":")[1].upper()
-        session = SessionLocal()
-        currency = session.query(Currency).filter_by(code=code).first()
-        session.close()
+        currency = get_registry().currency(code)
         if not currency:
             await query.message.reply_text(t("unknown_currency", lang))
             return
-        session = SessionLocal()
-        telegram_id = query.from_user.id
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
-        if user:
-            user.currency = currency.code
-        else:
-            user = User(
-                telegram_id=telegram_id,
-                language=lang,
-                currency=currency.code
-            )
-            session.add(user)
-        session.commit()
-        session.close()
-        context.user_data["currency"] = currency.code
+        await update_profile(query.from_user.id, defaults={"language": lang}, currency=currency["code"])
+        context.user_data["currency"] = currency["code"]
         await query.edit_message_text(
-            t("currency_set", lang, currency=f"{currency.code} {currency.flag} ({currency.symbol})")
+            t("currency_set", lang, currency=f"{currency['code']} {currency['flag']} ({currency['symbol']})")
         )
         filters_data = context.user_data.setdefault('filters', {})
         filters_data.setdefault('passengers', 1)
@@ -161,32 +145,30 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = context.user_data.get("lang", "ru")
-    telegram_id = update.effective_user.id
-    session = SessionLocal()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if not user:
+    profile = await get_profile(update.effective_user.id)
+    if not profile:
         await reply(update, t("history_user_not_found", lang))
-        session.close()
         return
-    user_history = (
-        session.query(SearchHistory)
-        .options(joinedload(SearchHistory.results))
-        .filter_by(user_id=user.id)
-        .order_by(SearchHistory.search_time.desc())
-        .limit(5)
-        .all()
-    )
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(SearchHistory)
+            .options(selectinload(SearchHistory.results))
+            .filter_by(user_id=profile["id"])
+            .order_by(SearchHistory.search_time.desc())
+            .limit(5)
+        )
+        user_history = result.scalars().all()
     if not user_history:
         await reply(update, t("no_history", lang))
-        session.close()
         return
+    import pytz
     history_messages = []
     for entry in user_history:
         moscow_tz = pytz.timezone("Europe/Moscow")
         utc_time = entry.search_time.replace(tzinfo=pytz.UTC)
         moscow_time = utc_time.astimezone(moscow_tz)
         msg = (f"📅 {moscow_time.strftime('%d.%m.%Y %H:%M')} ({t('moscow_time', lang)})\n"
-               f"✈ {entry.origin_city} → {entry.destination_city} ({datetime.datetime.strptime(entry.depart_date, '%Y-%m-%d').strftime('%d.%m.%Y')})\n"
+               f"✈ {entry.origin_city} → {entry.destination_city} ({entry.depart_date.strftime('%d.%m.%Y') if entry.depart_date else '—'})\n"
                f"👥 {entry.passengers} {plural_passenger(entry.passengers, lang)}")
         if entry.results:
             best = sorted(entry.results, key=lambda r: r.price)[0]
@@ -195,7 +177,6 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"{t('direct', lang) if entry.direct_only else t('with_transfers', lang)}")
         history_messages.append(msg)
     await reply(update, "\n\n".join(history_messages))
-    session.close()
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = context.user_data.get("lang", "ru")
@@ -203,7 +184,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text.strip().lower()
         if any(code in text.upper() for code in ["RUB", "USD", "EUR", "GBP", "KZT", "CNY"]) and "—" in text:
             return
-        parts = text.split()
+        parts = strip_prepositions(text.split())
         if len(parts) not in [2, 3]:
             await update.message.reply_text(t("invalid_format", lang))
             return
@@ -232,7 +213,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['calendar'] = {
                 'origin_city': origin_city,
                 'dest_city': dest_city,
-                'selected': [],
+                'selected': set(),
                 'month_offset': 0
             }
             context.user_data['calendar_mode'] = "track"
@@ -265,42 +246,39 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(reply_text, reply_markup=build_tracking_settings_keyboard(lang, price_val, percent_val))
         return
     if context.user_data.get("awaiting_feedback"):
-        session = SessionLocal()
-        telegram_id = update.effective_user.id
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
-        if user:
-            fb = Feedback(user_id=user.id, message=update.message.text)
-            session.add(fb)
-            session.commit()
+        profile = await get_profile(update.effective_user.id)
+        if profile:
+            async with AsyncSessionLocal() as session:
+                session.add(Feedback(user_id=profile["id"], message=update.message.text))
+                await session.commit()
             await update.message.reply_text(t("feedback_thanks", lang))
         else:
             await update.message.reply_text(t("user_not_found", lang))
-        session.close()
         context.user_data["awaiting_feedback"] = False
         return
     currency = context.user_data.get("currency", "RUB")
     passengers = context.user_data.get("filters", {}).get("passengers", 1)
     text = update.message.text.strip().lower()
-    parts = text.split()
+    parts = strip_prepositions(text.split())
     if len(parts) not in [2, 3]:
         await update.message.reply_text(t("invalid_format", lang))
         return
+    origin_code = await get_iata_code(parts[0])
+    dest_code = await get_iata_code(parts[1])
+    if not origin_code or not dest_code:
+        await update.message.reply_text(t("city_error", lang))
+        return
     if len(parts) == 2:
         context.user_data['calendar'] = {
             'origin_city': parts[0],
             'dest_city': parts[1],
-            'selected': [],
+            'selected': set(),
             'month_offset': 0
         }
         await show_calendar(update, context)
         return
     origin_city, dest_city = parts[0], parts[1]
     date_str = parts[2]
-    origin_code = get_iata_code(origin_city)
-    dest_code = get_iata_code(dest_city)
-    if not origin_code or not dest_code:
-        await update.message.reply_text(t("city_error", lang))
-        return
     depart_date = None
     try:
         parsed_date = datetime.datetime.strptime(date_str, "%d-%m-%Y")
@@ -310,7 +288,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data["calendar"] = {
                 'origin_city': origin_city,
                 'dest_city': dest_city,
-                'selected': [],
+                'selected': set(),
                 'month_offset': 0
             }
             await show_calendar(update, context)
@@ -320,33 +298,78 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(t("date_error", lang))
         return
     direct = context.user_data.get("filters", {}).get("direct", False)
-    reply_text = get_ticket_price(origin_code, dest_code, origin_city, dest_city, depart_date, currency, lang, passengers, direct=direct)
-    if not reply_text and direct:
-        alt_reply_text = get_ticket_price(origin_code, dest_code, origin_city, dest_city, depart_date, currency, lang, passengers, direct=False)
-        if alt_reply_text:
-            if passengers > 1:
-                alt_reply_text = f"{alt_reply_text}\n{t('multi_passenger_warning', lang)}"
-            await update.message.reply_text(t("no_direct_but_with_transfers", lang))
-            await update.message.reply_text(alt_reply_text, parse_mode='Markdown', disable_web_page_preview=True)
-            return
-    if not reply_text:
+    quotes, used_direct = await search_with_fallback(origin_code, dest_code, depart_date, currency, direct)
+    if not quotes:
         await update.message.reply_text(t("not_found", lang))
         return
+    reply_text = render_ticket_reply(quotes, origin_code, dest_code, origin_city, dest_city, currency, lang, passengers)
     if passengers > 1:
         reply_text += "\n" + t("multi_passenger_warning", lang)
+    if used_direct != direct:
+        await update.message.reply_text(t("no_direct_but_with_transfers", lang))
     await update.message.reply_text(reply_text, parse_mode='Markdown', disable_web_page_preview=True)
-    session = SessionLocal()
-    user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-    session.close()
-    if user:
-        save_search_and_results(user, origin_city, dest_city, depart_date, passengers, currency, direct)
+    user_id = await get_user_id(update.effective_user.id)
+    if user_id:
+        await save_search_and_results(user_id, origin_city, dest_city, parsed_date.date(), passengers, currency, used_direct, quotes, origin_code, dest_code)
+
+async def start_services(app):
+    start_dispatcher(app.bot)
+
+async def shutdown_services(app):
+    await stop_dispatcher()
+    await close_client()
+    await dispose_async_engine()
+
+STARTUP_STEPS = (
+    ("init_db", init_db),
+    ("seed_airlines", fill_airlines),
+    ("seed_currencies", fill_currencies),
+    ("seed_translations", fill_translations),
+    ("airlines_file", load_airlines_file),
+    ("reference_data", get_registry),
+    ("translation_catalog", get_translation_catalog),
+    ("keyboards", warm_keyboards),
+    ("city_index", get_city_index),
+)
+
+def run_startup_steps(timings):
+    for name, step in STARTUP_STEPS:
+        started = time.perf_counter()
+        step()
+        timings[name] = time.perf_counter() - started
+
+def log_startup_report(timings):
+    report = ", ".join(f"{name} {duration * 1000:.0f} мс" for name, duration in timings.items())
+    logging.info(f"⏱ Запуск за {sum(timings.values()) * 1000:.0f} мс: {report}")
+
+STATS_LOG_INTERVAL = 15 * 60
+
+RUNTIME_STATS = (
+    ("city_cache", city_cache_stats),
+    ("quote_cache", quote_cache_stats),
+    ("tp_client", client_stats),
+    ("profile_cache", profile_cache_stats),
+    ("notifier", dispatcher_stats),
+)
+
+def log_runtime_stats(sources=RUNTIME_STATS):
+    for name, collect in sources:
+        logging.info(f"📊 {name}: {collect()}")
 
 async def main():
-    init_db()
-    fill_airlines()
-    fill_currencies()
-    fill_translations()
-    app = ApplicationBuilder().token(API_TOKEN).build()
+    timings = {"imports": IMPORT_DURATION}
+    run_startup_steps(timings)
+    app = (
+        ApplicationBuilder()
+        .token(API_TOKEN)
+        .persistence(SQLitePersistence())
+        .post_init(start_services)
+        .post_shutdown(shutdown_services)
+        .build()
+    )
+    state_manager = StateLifecycleManager(app)
+    app.bot_data["state_manager"] = state_manager
+    app.add_handler(TypeHandler(Update, state_manager.touch), group=-1)
     app.add_handler(CommandHandler("start", choose_language))
     app.add_handler(CommandHandler("filters", filters_command))
     app.add_handler(CallbackQueryHandler(filter_callback, pattern="^passenger_.*|filters_done|filters_reset|toggle_direct$"))
@@ -377,12 +400,22 @@ async def main():
         BotCommand("feedback", "✉️ Оставить отзыв / Leave feedback"),
         BotCommand("help", "ℹ️ Помощь / Help"),
     ])
+    started = time.perf_counter()
     from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from track_scheduler import TrackingScheduler, TRACKING_TICK
+    from maintenance import run_maintenance, MAINTENANCE_INTERVAL
     scheduler = AsyncIOScheduler()
-    async def run_tracked_check():
-        await check_prices_for_all(app.bot)
-    scheduler.add_job(run_tracked_check, "interval", minutes=30)
+    tracking_scheduler = TrackingScheduler(app.bot)
+    app.bot_data["tracking_scheduler"] = tracking_scheduler
+    scheduler.add_job(tracking_scheduler.tick, "interval", seconds=TRACKING_TICK, max_instances=1, coalesce=True)
+    scheduler.add_job(run_maintenance, "interval", seconds=MAINTENANCE_INTERVAL, max_instances=1, coalesce=True,
+                      next_run_time=datetime.datetime.now() + datetime.timedelta(minutes=5))
+    scheduler.add_job(log_runtime_stats, "interval", seconds=STATS_LOG_INTERVAL, max_instances=1, coalesce=True,
+                      args=[(*RUNTIME_STATS, ("persistence", app.persistence.snapshot))])
+    scheduler.add_job(state_manager.sweep, "interval", seconds=STATE_SWEEP_INTERVAL, max_instances=1, coalesce=True)
     scheduler.start()
+    timings["scheduler"] = time.perf_counter() - started
+    log_startup_report(timings)
     print("Бот запущен!")
     app.add_handler(CallbackQueryHandler(calendar_callback))
     await app.run_polling()
@@ -0,0 +1,111 @@
+import logging
+import asyncio
+import datetime
+import time
+from sqlalchemy import text, update
+from db import engine, AsyncSessionLocal
+from models import TrackedRoute
+from price_history import compact_price_history
+from migrations import AUTO_VACUUM_INCREMENTAL
+
+MAINTENANCE_INTERVAL = 6 * 60 * 60
+SEARCH_RESULTS_RETENTION_DAYS = 30
+SEARCH_HISTORY_RETENTION_DAYS = 180
+NOTIFICATION_RETENTION_DAYS = 90
+USER_STATE_RETENTION_DAYS = 90
+PURGE_BATCH_SIZE = 500
+PURGE_BATCH_PAUSE = 0.05
+VACUUM_PAGES = 2000
+ANALYSIS_LIMIT = 400
+
+RETENTION_QUERIES = {
+    "search_results": (
+        "DELETE FROM search_results WHERE id IN ("
+        "SELECT r.id FROM search_results r JOIN search_history h ON h.id = r.search_id "
+        "WHERE h.search_time < :results_cutoff LIMIT :batch)"
+    ),
+    "search_history": (
+        "DELETE FROM search_history WHERE id IN ("
+        "SELECT id FROM search_history WHERE search_time < :history_cutoff "
+        "AND NOT EXISTS (SELECT 1 FROM search_results r WHERE r.search_id = search_history.id) LIMIT :batch)"
+    ),
+    "notifications": (
+        "DELETE FROM notifications WHERE id IN ("
+        "SELECT id FROM notifications WHERE sent_at < :notifications_cutoff LIMIT :batch)"
+    ),
+    "user_states": (
+        "DELETE FROM user_states WHERE user_id IN ("
+        "SELECT user_id FROM user_states WHERE updated_at < :states_cutoff LIMIT :batch)"
+    ),
+}
+
+async def deactivate_expired_routes(today=None):
+    today = today or datetime.date.today()
+    async with AsyncSessionLocal() as session:
+        try:
+            expired = (await session.execute(
+                update(TrackedRoute)
+                .where(TrackedRoute.active == True, TrackedRoute.depart_date < today)
+                .values(active=False)
+            )).rowcount
+            await session.commit()
+            return expired
+        except Exception as e:
+            await session.rollback()
+            logging.warning(f"❗ Не удалось деактивировать прошедшие отслеживания: {e}")
+            return 0
+
+def retention_params(now=None, batch=PURGE_BATCH_SIZE):
+    now = now or datetime.datetime.utcnow()
+    return {
+        "results_cutoff": now - datetime.timedelta(days=SEARCH_RESULTS_RETENTION_DAYS),
+        "history_cutoff": now - datetime.timedelta(days=SEARCH_HISTORY_RETENTION_DAYS),
+        "notifications_cutoff": now - datetime.timedelta(days=NOTIFICATION_RETENTION_DAYS),
+        "states_cutoff": now - datetime.timedelta(days=USER_STATE_RETENTION_DAYS),
+        "batch": batch,
+    }
+
+async def purge_in_batches(sql, params, pause=PURGE_BATCH_PAUSE):
+    removed = 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            try:
+                deleted = (await session.execute(text(sql), params)).rowcount
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                logging.warning(f"❗ Ошибка при очистке старых записей: {e}")
+                return removed
+        removed += deleted
+        if deleted < params["batch"]:
+            return removed
+        await asyncio.sleep(pause)
+
+def vacuum_database(bind=engine, pages=VACUUM_PAGES):
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        free_pages = 0
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == AUTO_VACUUM_INCREMENTAL:
+            free_pages = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            if free_pages:
+                conn.exec_driver_sql(f"PRAGMA incremental_vacuum({pages})")
+        else:
+            logging.info("🧹 Инкрементальный VACUUM выключен, запустите `python migrations.py` при остановленном боте")
+        conn.exec_driver_sql(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        conn.exec_driver_sql("PRAGMA optimize")
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        return min(free_pages, pages)
+
+async def run_maintenance():
+    started = time.monotonic()
+    stats = {"expired_routes": await deactivate_expired_routes()}
+    params = retention_params()
+    for table, sql in RETENTION_QUERIES.items():
+        stats[table] = await purge_in_batches(sql, params)
+    await asyncio.to_thread(compact_price_history)
+    try:
+        stats["vacuumed_pages"] = await asyncio.to_thread(vacuum_database)
+    except Exception as e:
+        logging.warning(f"❗ Ошибка при VACUUM/ANALYZE: {e}")
+    stats["duration"] = round(time.monotonic() - started, 3)
+    logging.info(f"🧽 Обслуживание БД: {stats}")
+    return stats
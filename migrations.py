@@ -0,0 +1,81 @@
+import logging
+from models import Base
+
+def create_indexes(conn, *names):
+    indexes = {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+def add_hot_path_indexes(conn):
+    create_indexes(
+        conn,
+        "ix_search_history_user_time",
+        "ix_search_results_search_id",
+        "ix_tracked_routes_active_id",
+        "ix_tracked_routes_user_active",
+        "ix_translations_key_lang",
+    )
+
+def add_depart_date_indexes(conn):
+    create_indexes(conn, "ix_search_history_depart_date", "ix_tracked_routes_active_date")
+
+def add_retention_indexes(conn):
+    create_indexes(conn, "ix_search_history_time", "ix_feedback_sent_at", "ix_notifications_sent_at")
+
+def add_route_pair_index(conn):
+    create_indexes(conn, "ix_tracked_routes_pair_date")
+
+DMY_PATTERN = "[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]"
+ISO_PATTERN = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+
+def convert_depart_dates(conn):
+    converted = conn.exec_driver_sql(
+        "UPDATE tracked_routes SET depart_date = "
+        "substr(depart_date, 7, 4) || '-' || substr(depart_date, 4, 2) || '-' || substr(depart_date, 1, 2) "
+        f"WHERE depart_date GLOB '{DMY_PATTERN}'"
+    ).rowcount
+    invalid_routes = conn.exec_driver_sql(
+        "UPDATE tracked_routes SET depart_date = NULL, active = 0 "
+        f"WHERE depart_date IS NOT NULL AND depart_date NOT GLOB '{ISO_PATTERN}'"
+    ).rowcount
+    invalid_history = conn.exec_driver_sql(
+        "UPDATE search_history SET depart_date = NULL "
+        f"WHERE depart_date IS NOT NULL AND depart_date NOT GLOB '{ISO_PATTERN}'"
+    ).rowcount
+    logging.info(
+        f"📅 Даты отслеживаний переведены в ISO: {converted}, "
+        f"некорректных отслеживаний: {invalid_routes}, некорректных записей истории: {invalid_history}"
+    )
+
+MIGRATIONS = [
+    add_hot_path_indexes,
+    convert_depart_dates,
+    add_depart_date_indexes,
+    add_retention_indexes,
+    add_route_pair_index,
+]
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+def enable_incremental_vacuum(engine):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == AUTO_VACUUM_INCREMENTAL:
+            return False
+        logging.info("🧹 Включение инкрементального VACUUM (полный VACUUM, бот должен быть остановлен)")
+        conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+        return True
+
+def run_migrations(engine):
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info(f"🛠 Миграция БД {number}: {migration.__name__}")
+            migration(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    from db import init_db, engine
+    init_db()
+    enable_incremental_vacuum(engine)
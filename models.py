@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Date
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Date, LargeBinary, UniqueConstraint, Index
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
 
@@ -23,12 +23,16 @@ class User(Base):
 
 class SearchHistory(Base):
     __tablename__ = 'search_history'
+    __table_args__ = (
+        Index('ix_search_history_user_time', 'user_id', 'search_time'),
+        Index('ix_search_history_time', 'search_time'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     origin_city = Column(String)
     destination_city = Column(String)
-    depart_date = Column(String) 
+    depart_date = Column(Date, index=True)
     passengers = Column(Integer)
     direct_only = Column(Boolean)
     search_time = Column(DateTime, default=datetime.utcnow)
@@ -40,7 +44,7 @@ class SearchResult(Base):
     __tablename__ = 'search_results'
 
     id = Column(Integer, primary_key=True)
-    search_id = Column(Integer, ForeignKey('search_history.id'))
+    search_id = Column(Integer, ForeignKey('search_history.id'), index=True)
     airline_code = Column(String)
     departure_date = Column(Date)
     price = Column(Integer)
@@ -51,13 +55,19 @@ class SearchResult(Base):
 
 class TrackedRoute(Base):
     __tablename__ = 'tracked_routes'
+    __table_args__ = (
+        Index('ix_tracked_routes_active_id', 'active', 'id'),
+        Index('ix_tracked_routes_user_active', 'user_id', 'active'),
+        Index('ix_tracked_routes_active_date', 'active', 'depart_date'),
+        Index('ix_tracked_routes_pair_date', 'origin_city', 'destination_city', 'active', 'depart_date'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     currency = Column(String, default='RUB')
     origin_city = Column(String)
     destination_city = Column(String)
-    depart_date = Column(String)  
+    depart_date = Column(Date)
     notify_below_price = Column(Integer, nullable=True)
     price_drop_percent = Column(Integer, nullable=True)
     active = Column(Boolean, default=True)
@@ -74,7 +84,7 @@ class Feedback(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     message = Column(Text)
-    sent_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, default=datetime.utcnow, index=True)
 
     user = relationship("User", back_populates="feedbacks")
 
@@ -85,7 +95,7 @@ class Notification(Base):
     user_id = Column(Integer, ForeignKey('users.id'))
     route_id = Column(Integer, ForeignKey('tracked_routes.id'), nullable=True)
     message = Column(Text)
-    sent_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, default=datetime.utcnow, index=True)
 
     user = relationship("User", back_populates="notifications")
 
@@ -108,8 +118,48 @@ class Currency(Base):
 
 class Translation(Base):
     __tablename__ = 'translations'
+    __table_args__ = (Index('ix_translations_key_lang', 'key', 'lang'),)
 
     id = Column(Integer, primary_key=True)
     key = Column(String)
     lang = Column(String)
     value = Column(Text)
+
+class CityCode(Base):
+    __tablename__ = 'city_codes'
+
+    name = Column(String, primary_key=True)
+    code = Column(String, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class PriceRouteKey(Base):
+    __tablename__ = 'price_route_keys'
+    __table_args__ = (UniqueConstraint('origin', 'destination', 'depart_date', 'currency'),)
+
+    id = Column(Integer, primary_key=True)
+    origin = Column(String)
+    destination = Column(String)
+    depart_date = Column(Date)
+    currency = Column(String)
+
+class PriceSnapshot(Base):
+    __tablename__ = 'price_snapshots'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    route_key_id = Column(Integer, ForeignKey('price_route_keys.id'), primary_key=True)
+    ts = Column(Integer, primary_key=True)
+    min_price = Column(Integer)
+
+class SeedVersion(Base):
+    __tablename__ = 'seed_versions'
+
+    name = Column(String, primary_key=True)
+    digest = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class UserState(Base):
+    __tablename__ = 'user_states'
+
+    user_id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,195 @@
+import logging
+import asyncio
+import datetime
+import time
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+from sqlalchemy import insert
+from db import AsyncSessionLocal
+from models import Notification
+from ratelimit import TokenBucket
+
+GLOBAL_RATE = 25.0
+GLOBAL_BURST = 25
+PER_CHAT_INTERVAL = 1.0
+DISPATCH_WORKERS = 4
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+NOTIFICATION_FLUSH_SIZE = 50
+NOTIFICATION_FLUSH_INTERVAL = 2.0
+
+def _retry_delay(retry_after):
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class NotificationDispatcher:
+    def __init__(self, bot, workers=DISPATCH_WORKERS):
+        self.bot = bot
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_next_at = {}
+        self.pending_rows = []
+        self.stats = {"queued": 0, "sent": 0, "retried": 0, "failed": 0, "persisted": 0, "flood_waits": 0, "parked": 0}
+        self._tasks = []
+        self._retries = set()
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._flush_loop()))
+
+    async def _drain(self):
+        while True:
+            await self.queue.join()
+            if not self._retries:
+                return
+            await asyncio.wait(set(self._retries))
+
+    async def stop(self, drain_timeout=10.0):
+        try:
+            await asyncio.wait_for(self._drain(), drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"⚠️ Не доставлено уведомлений при остановке: {self.queue.qsize() + len(self._retries)}")
+        for task in [*self._tasks, *self._retries]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._retries, return_exceptions=True)
+        self._tasks = []
+        self._retries.clear()
+        await self.flush()
+
+    def enqueue(self, user_id, chat_id, route_id, text, reply_markup=None):
+        self.queue.put_nowait({
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "route_id": route_id,
+            "text": text,
+            "reply_markup": reply_markup,
+            "attempt": 0,
+        })
+        self.stats["queued"] += 1
+
+    def _chat_send_at(self, item):
+        if "send_at" not in item:
+            chat_id = item["chat_id"]
+            item["send_at"] = max(time.monotonic(), self.chat_next_at.get(chat_id, 0.0))
+            self.chat_next_at[chat_id] = item["send_at"] + PER_CHAT_INTERVAL
+        return item["send_at"]
+
+    def _requeue_after(self, item, delay):
+        async def requeue():
+            await asyncio.sleep(delay)
+            self.queue.put_nowait(item)
+        task = asyncio.create_task(requeue())
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    def _retry_later(self, item, delay):
+        self._requeue_after(item, delay)
+        self.stats["retried"] += 1
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                logging.warning(f"❗ Ошибка диспетчера уведомлений: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, item):
+        delay = self._chat_send_at(item) - time.monotonic()
+        if delay > 0:
+            self._requeue_after(item, delay)
+            self.stats["parked"] += 1
+            return
+        del item["send_at"]
+        await self.global_bucket.acquire()
+        try:
+            await self.bot.send_message(
+                chat_id=item["chat_id"],
+                text=item["text"],
+                parse_mode='Markdown',
+                reply_markup=item["reply_markup"]
+            )
+        except RetryAfter as e:
+            delay = _retry_delay(e.retry_after)
+            chat_id = item["chat_id"]
+            self.chat_next_at[chat_id] = max(self.chat_next_at.get(chat_id, 0.0), time.monotonic() + delay)
+            self.global_bucket.pause(delay)
+            self.stats["flood_waits"] += 1
+            self._retry_later(item, delay)
+            return
+        except (Forbidden, BadRequest) as e:
+            self.stats["failed"] += 1
+            logging.warning(f"❗ Уведомление для {item['chat_id']} отклонено: {e}")
+            return
+        except (TimedOut, NetworkError) as e:
+            item["attempt"] += 1
+            if item["attempt"] >= MAX_ATTEMPTS:
+                self.stats["failed"] += 1
+                logging.warning(f"❗ Уведомление для {item['chat_id']} не доставлено после {MAX_ATTEMPTS} попыток: {e}")
+                return
+            self._retry_later(item, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (item["attempt"] - 1)))
+            return
+        self.stats["sent"] += 1
+        self.pending_rows.append({
+            "user_id": item["user_id"],
+            "route_id": item["route_id"],
+            "message": item["text"],
+            "sent_at": datetime.datetime.utcnow(),
+        })
+        if len(self.pending_rows) >= NOTIFICATION_FLUSH_SIZE:
+            await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(NOTIFICATION_FLUSH_INTERVAL)
+            await self.flush()
+            now = time.monotonic()
+            for chat_id in [c for c, next_at in self.chat_next_at.items() if next_at < now]:
+                del self.chat_next_at[chat_id]
+
+    async def flush(self):
+        if not self.pending_rows:
+            return
+        rows, self.pending_rows = self.pending_rows, []
+        async with AsyncSessionLocal() as session:
+            try:
+                await session.execute(insert(Notification), rows)
+                await session.commit()
+                self.stats["persisted"] += len(rows)
+            except Exception as e:
+                await session.rollback()
+                logging.warning(f"❗ Не удалось сохранить уведомления ({len(rows)}): {e}")
+
+    def snapshot(self):
+        return {**self.stats, "queue_depth": self.queue.qsize(), "pending_rows": len(self.pending_rows)}
+
+_dispatcher = None
+
+def get_dispatcher():
+    return _dispatcher
+
+def dispatcher_stats():
+    return _dispatcher.snapshot() if _dispatcher is not None else {}
+
+def start_dispatcher(bot):
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = NotificationDispatcher(bot)
+    _dispatcher.start()
+    return _dispatcher
+
+async def stop_dispatcher():
+    global _dispatcher
+    if _dispatcher is not None:
+        await _dispatcher.stop()
+    _dispatcher = None
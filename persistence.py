@@ -0,0 +1,214 @@
+import logging
+import asyncio
+import datetime
+import json
+import zlib
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+from telegram.ext import BasePersistence, PersistenceInput
+from db import AsyncSessionLocal
+from models import UserState
+from user_cache import get_profile
+
+STATE_UPDATE_INTERVAL = 15
+STATE_FLUSH_DELAY = 0.5
+STATE_WRITE_BATCH = 500
+COMPRESS_THRESHOLD = 256
+
+RAW_PREFIX = b"j"
+ZLIB_PREFIX = b"z"
+
+def _encode_value(value):
+    if isinstance(value, (set, frozenset)):
+        return {"$set": sorted(value, key=str)}
+    if isinstance(value, datetime.date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Unsupported state value: {type(value).__name__}")
+
+def _decode_value(obj):
+    if len(obj) == 1:
+        if "$set" in obj:
+            return set(obj["$set"])
+        if "$date" in obj:
+            return datetime.date.fromisoformat(obj["$date"])
+    return obj
+
+def encode_state(data):
+    payload = json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=_encode_value).encode("utf-8")
+    if len(payload) > COMPRESS_THRESHOLD:
+        return ZLIB_PREFIX + zlib.compress(payload)
+    return RAW_PREFIX + payload
+
+def decode_state(blob):
+    prefix, payload = blob[:1], blob[1:]
+    if prefix == ZLIB_PREFIX:
+        payload = zlib.decompress(payload)
+    return json.loads(payload, object_hook=_decode_value)
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval=STATE_UPDATE_INTERVAL, flush_delay=STATE_FLUSH_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.flush_delay = flush_delay
+        self.loaded_users = set()
+        self.dirty = {}
+        self.dropped = set()
+        self.evicted = set()
+        self.state_sizes = {}
+        self.stats = {"loaded": 0, "written": 0, "dropped": 0, "evicted": 0, "bytes": 0}
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self.loaded_users:
+            return
+        self.loaded_users.add(user_id)
+        stored = await self.load_user_state(user_id)
+        if stored is None:
+            profile = await get_profile(user_id)
+            stored = {"lang": profile["language"], "currency": profile["currency"]} if profile else {}
+        for key, value in stored.items():
+            user_data.setdefault(key, value)
+
+    async def load_user_state(self, user_id):
+        if user_id in self.dirty:
+            return decode_state(self.dirty[user_id])
+        if user_id in self.dropped:
+            return None
+        async with AsyncSessionLocal() as session:
+            blob = (await session.execute(select(UserState.data).filter_by(user_id=user_id))).scalar()
+        if blob is None:
+            return None
+        self.stats["loaded"] += 1
+        self.state_sizes[user_id] = len(blob)
+        try:
+            return decode_state(blob)
+        except (ValueError, zlib.error) as e:
+            logging.warning(f"❗ Повреждённое состояние пользователя {user_id}: {e}")
+            return None
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            self.dirty.pop(user_id, None)
+            self.state_sizes.pop(user_id, None)
+            self.dropped.add(user_id)
+            self._schedule_flush()
+            return
+        try:
+            blob = encode_state(data)
+        except (TypeError, ValueError) as e:
+            logging.warning(f"❗ Не удалось сериализовать состояние пользователя {user_id}: {e}")
+            return
+        self.dirty[user_id] = blob
+        self.state_sizes[user_id] = len(blob)
+        self.dropped.discard(user_id)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self.state_sizes.pop(user_id, None)
+        if user_id in self.evicted:
+            self.evicted.discard(user_id)
+            self.loaded_users.discard(user_id)
+            return
+        self.dirty.pop(user_id, None)
+        self.dropped.add(user_id)
+        self.loaded_users.discard(user_id)
+        self._schedule_flush()
+
+    def mark_evicted(self, user_ids):
+        self.evicted.update(user_ids)
+        self.loaded_users.difference_update(user_ids)
+        self.stats["evicted"] += len(user_ids)
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await asyncio.shield(self.write_pending())
+
+    async def write_pending(self):
+        async with self._write_lock:
+            if not self.dirty and not self.dropped:
+                return
+            dirty, self.dirty = self.dirty, {}
+            dropped, self.dropped = self.dropped, set()
+            now = datetime.datetime.utcnow()
+            rows = [{"user_id": user_id, "data": blob, "updated_at": now} for user_id, blob in dirty.items()]
+            async with AsyncSessionLocal() as session:
+                try:
+                    for start in range(0, len(rows), STATE_WRITE_BATCH):
+                        stmt = insert(UserState)
+                        await session.execute(
+                            stmt.on_conflict_do_update(
+                                index_elements=[UserState.user_id],
+                                set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+                            ),
+                            rows[start:start + STATE_WRITE_BATCH]
+                        )
+                    if dropped:
+                        await session.execute(delete(UserState).where(UserState.user_id.in_(list(dropped))))
+                    await session.commit()
+                except Exception as e:
+                    await session.rollback()
+                    logging.warning(f"❗ Не удалось сохранить состояние пользователей ({len(rows)}): {e}")
+                    for user_id, blob in dirty.items():
+                        self.dirty.setdefault(user_id, blob)
+                    self.dropped |= dropped - set(self.dirty)
+                    return
+            self.stats["written"] += len(rows)
+            self.stats["dropped"] += len(dropped)
+            self.stats["bytes"] += sum(len(row["data"]) for row in rows)
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.write_pending()
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "resident_users": len(self.loaded_users),
+            "resident_bytes": sum(self.state_sizes.values()),
+            "pending": len(self.dirty) + len(self.dropped),
+        }
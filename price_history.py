@@ -0,0 +1,121 @@
+import logging
+import datetime
+import time
+from sqlalchemy import func, select, text, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from db import SessionLocal, AsyncSessionLocal
+from models import PriceRouteKey, PriceSnapshot
+
+HOUR = 3600
+DAY = 24 * HOUR
+HOURLY_RETENTION_DAYS = 7
+SNAPSHOT_RETENTION_DAYS = 180
+BASELINE_DAYS = 14
+KEY_LOOKUP_CHUNK = 200
+
+_route_key_ids = {}
+_pending = {}
+
+def _bucket(ts, size):
+    return int(ts) // size * size
+
+def price_key(origin, destination, depart_date, currency):
+    return (origin, destination, depart_date, (currency or "RUB").upper())
+
+def record_price(key, price, ts=None):
+    bucket = _bucket(ts if ts is not None else time.time(), HOUR)
+    previous = _pending.get((key, bucket))
+    if previous is None or price < previous:
+        _pending[(key, bucket)] = price
+
+async def _resolve_route_keys(session, keys, create=True):
+    missing = [key for key in keys if key not in _route_key_ids]
+    if missing and create:
+        await session.execute(
+            insert(PriceRouteKey).on_conflict_do_nothing(),
+            [{"origin": o, "destination": d, "depart_date": day, "currency": c} for o, d, day, c in missing]
+        )
+    columns = (PriceRouteKey.origin, PriceRouteKey.destination, PriceRouteKey.depart_date, PriceRouteKey.currency)
+    for start in range(0, len(missing), KEY_LOOKUP_CHUNK):
+        chunk = missing[start:start + KEY_LOOKUP_CHUNK]
+        result = await session.execute(select(PriceRouteKey.id, *columns).filter(tuple_(*columns).in_(chunk)))
+        for row in result:
+            _route_key_ids[(row.origin, row.destination, row.depart_date, row.currency)] = row.id
+    return {key: _route_key_ids[key] for key in keys if key in _route_key_ids}
+
+async def flush_price_snapshots():
+    if not _pending:
+        return 0
+    pending = dict(_pending)
+    _pending.clear()
+    async with AsyncSessionLocal() as session:
+        try:
+            ids = await _resolve_route_keys(session, list({key for key, _ in pending}))
+            rows = [
+                {"route_key_id": ids[key], "ts": bucket, "min_price": price}
+                for (key, bucket), price in pending.items() if key in ids
+            ]
+            stmt = insert(PriceSnapshot)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[PriceSnapshot.route_key_id, PriceSnapshot.ts],
+                set_={"min_price": func.min(PriceSnapshot.min_price, stmt.excluded.min_price)}
+            )
+            await session.execute(stmt, rows)
+            await session.commit()
+            return len(rows)
+        except Exception as e:
+            await session.rollback()
+            logging.warning(f"❗ Не удалось сохранить снимки цен ({len(pending)}): {e}")
+            return 0
+
+async def load_baselines(keys, days=BASELINE_DAYS, now=None):
+    if not keys:
+        return {}
+    since = (now if now is not None else time.time()) - days * DAY
+    async with AsyncSessionLocal() as session:
+        ids = await _resolve_route_keys(session, list(keys), create=False)
+        stats = {}
+        if ids:
+            rows = await session.execute(
+                select(PriceSnapshot.route_key_id, func.min(PriceSnapshot.min_price), func.avg(PriceSnapshot.min_price))
+                .filter(PriceSnapshot.route_key_id.in_(list(ids.values())), PriceSnapshot.ts >= since)
+                .group_by(PriceSnapshot.route_key_id)
+            )
+            stats = {route_key_id: {"min": low, "avg": avg} for route_key_id, low, avg in rows}
+    return {key: stats[route_key_id] for key, route_key_id in ids.items() if route_key_id in stats}
+
+def compact_price_history(now=None):
+    now = now if now is not None else time.time()
+    params = {
+        "day": DAY,
+        "hourly_cutoff": _bucket(now - HOURLY_RETENTION_DAYS * DAY, DAY),
+        "retention_cutoff": now - SNAPSHOT_RETENTION_DAYS * DAY,
+        "today": datetime.date.today(),
+    }
+    session = SessionLocal()
+    try:
+        session.execute(text(
+            "INSERT INTO price_snapshots (route_key_id, ts, min_price) "
+            "SELECT route_key_id, ts / :day * :day, MIN(min_price) FROM price_snapshots "
+            "WHERE ts < :hourly_cutoff AND ts % :day != 0 "
+            "GROUP BY route_key_id, ts / :day "
+            "ON CONFLICT (route_key_id, ts) DO UPDATE SET min_price = min(min_price, excluded.min_price)"
+        ), params)
+        downsampled = session.execute(text(
+            "DELETE FROM price_snapshots WHERE ts < :hourly_cutoff AND ts % :day != 0"
+        ), params).rowcount
+        expired = session.execute(text(
+            "DELETE FROM price_snapshots WHERE ts < :retention_cutoff "
+            "OR route_key_id IN (SELECT id FROM price_route_keys WHERE depart_date < :today)"
+        ), params).rowcount
+        session.query(PriceRouteKey).filter(PriceRouteKey.depart_date < params["today"]).delete(synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.warning(f"❗ Ошибка при сжатии истории цен: {e}")
+        return
+    finally:
+        session.close()
+    for key in [key for key in list(_route_key_ids) if key[2] < params["today"]]:
+        del _route_key_ids[key]
+    logging.info(f"🗜 История цен: прорежено {downsampled}, удалено {expired} точек")
@@ -0,0 +1,32 @@
+import logging
+from db import engine, init_db
+
+HOT_QUERIES = {
+    "active_routes_chunk": "SELECT id FROM tracked_routes WHERE active = 1 AND id > 0 ORDER BY id LIMIT 1000",
+    "planned_routes": "SELECT id FROM tracked_routes WHERE origin_city = 'москва' AND destination_city = 'сочи' AND active = 1 AND depart_date BETWEEN '2026-01-01' AND '2026-01-31'",
+    "user_routes": "SELECT * FROM tracked_routes WHERE user_id = 1 AND active = 1",
+    "active_routes_by_date": "SELECT id FROM tracked_routes WHERE active = 1 AND depart_date >= '2026-01-01' AND depart_date <= '2026-02-01'",
+    "user_history": "SELECT * FROM search_history WHERE user_id = 1 ORDER BY search_time DESC LIMIT 5",
+    "translation": "SELECT value FROM translations WHERE key = 'welcome' AND lang = 'ru'",
+    "search_results": "SELECT * FROM search_results WHERE search_id = 1",
+    "user_by_telegram_id": "SELECT * FROM users WHERE telegram_id = 1",
+    "history_retention": "SELECT id FROM search_history WHERE search_time < '2026-01-01' LIMIT 500",
+    "notifications_retention": "SELECT id FROM notifications WHERE sent_at < '2026-01-01' LIMIT 500",
+}
+
+def check_query_plans(bind=engine):
+    report = {}
+    with bind.connect() as conn:
+        for name, sql in HOT_QUERIES.items():
+            plan = " | ".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"))
+            report[name] = (plan, "USING" in plan and "INDEX" in plan or "PRIMARY KEY" in plan)
+    return report
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    failed = False
+    for name, (plan, indexed) in check_query_plans().items():
+        print(f"{'✅' if indexed else '❌'} {name}: {plan}")
+        failed = failed or not indexed
+    raise SystemExit(1 if failed else 0)
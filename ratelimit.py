@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.waited = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def pause(self, delay):
+        resume_at = time.monotonic() + delay
+        if resume_at > self.updated_at:
+            self.tokens = 0
+            self.updated_at = resume_at
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                delay = max(self.updated_at - time.monotonic(), 0.0)
+                if not delay and self.tokens >= 1:
+                    break
+                delay = delay or (1 - self.tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+            self.tokens -= 1
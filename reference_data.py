@@ -0,0 +1,105 @@
+import logging
+import hashlib
+import json
+import datetime
+from pathlib import Path
+from types import MappingProxyType
+from sqlalchemy.dialects.sqlite import insert
+from db import SessionLocal
+from models import Airline, Currency, SeedVersion
+
+AIRLINES_FILE = Path(__file__).parent / "data" / "airlines.json"
+AIRLINE_BATCH_SIZE = 500
+
+class ReferenceRegistry:
+    def __init__(self, airlines, currencies, version):
+        self.airlines = MappingProxyType(airlines)
+        self.currencies = MappingProxyType(currencies)
+        self.version = version
+
+    def airline_name(self, code, lang="ru"):
+        airline = self.airlines.get(code)
+        if airline and lang == "ru" and airline["name_ru"]:
+            return airline["name_ru"]
+        return code
+
+    def currency(self, code):
+        return self.currencies.get((code or "").upper())
+
+    def currency_flag(self, code):
+        currency = self.currency(code)
+        return currency["flag"] if currency else ""
+
+def load_registry(version=1):
+    session = SessionLocal()
+    airlines = {
+        code: {"name_ru": name_ru, "name_en": name_en}
+        for code, name_ru, name_en in session.query(Airline.code, Airline.name_ru, Airline.name_en)
+    }
+    currencies = {
+        code: {"code": code, "name": name, "symbol": symbol, "flag": flag}
+        for code, name, symbol, flag in session.query(Currency.code, Currency.name, Currency.symbol, Currency.flag)
+    }
+    session.close()
+    return ReferenceRegistry(airlines, currencies, version)
+
+_registry = None
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = load_registry()
+        logging.info(f"📚 Справочники загружены: {len(_registry.airlines)} авиакомпаний, {len(_registry.currencies)} валют")
+    return _registry
+
+def refresh_registry():
+    global _registry
+    _registry = load_registry(_registry.version + 1 if _registry else 1)
+    return _registry.version
+
+def registry_version():
+    return get_registry().version
+
+def _airline_row(item):
+    translations = item.get("name_translations") or {}
+    name_en = item.get("name_en") or translations.get("en") or item.get("name")
+    return {
+        "code": item["code"],
+        "name_ru": item.get("name_ru") or translations.get("ru") or name_en,
+        "name_en": name_en,
+    }
+
+def load_airlines_file(path=AIRLINES_FILE):
+    path = Path(path)
+    if not path.exists():
+        return 0
+    raw = path.read_bytes()
+    digest = hashlib.sha256(raw).hexdigest()
+    name = f"airlines_file:{path.name}"
+    session = SessionLocal()
+    try:
+        version = session.get(SeedVersion, name)
+        if version is not None and version.digest == digest:
+            return 0
+        rows = [_airline_row(item) for item in json.loads(raw) if item.get("code")]
+        for start in range(0, len(rows), AIRLINE_BATCH_SIZE):
+            stmt = insert(Airline)
+            session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[Airline.code],
+                    set_={"name_ru": stmt.excluded.name_ru, "name_en": stmt.excluded.name_en}
+                ),
+                rows[start:start + AIRLINE_BATCH_SIZE]
+            )
+        session.merge(SeedVersion(name=name, digest=digest, updated_at=datetime.datetime.utcnow()))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.warning(f"❗ Не удалось загрузить авиакомпании из {path}: {e}")
+        return 0
+    finally:
+        session.close()
+    logging.info(f"✈️ Загружено авиакомпаний из {path.name}: {len(rows)}")
+    if _registry is not None:
+        refresh_registry()
+    return len(rows)
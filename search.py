@@ -1,149 +1,225 @@
 import logging
-import requests
+import asyncio
 import datetime
-from db import SessionLocal
-from models import Airline, SearchHistory, SearchResult, User
-from utils import t, get_currency_flag, TP_API_TOKEN
-
-def get_iata_code(city_name: str):
-    url = 'https://autocomplete.travelpayouts.com/places2'
-    params = {'term': city_name, 'locale': 'ru', 'types[]': 'city'}
-    response = requests.get(url, params=params)
-    data = response.json()
-    if data:
-        return data[0]['code']
-    return None
-
-def get_ticket_price(origin, destination, origin_name, dest_name, requested_date=None, currency="rub", lang="ru", passengers=1, direct=False):
-    url = 'https://api.travelpayouts.com/aviasales/v3/prices_for_dates'
-    departure_at = requested_date or datetime.date.today().strftime('%Y-%m')
-    params = {
-        'origin': origin,
-        'destination': destination,
-        'departure_at': departure_at,
-        'one_way': 'true',
-        'direct': str(direct).lower(),
-        'currency': currency.lower(),
-        'sorting': 'price',
-        'limit': 30,
-        'page': 1,
-        'token': TP_API_TOKEN
-    }
-    response = requests.get(url, params=params)
-    data = response.json()
-    if not data.get("success") or not data.get("data") or len(data["data"]) == 0:
+import time
+from collections import defaultdict
+from db import AsyncSessionLocal
+from models import SearchHistory, SearchResult
+from utils import t, TP_API_TOKEN
+from reference_data import get_registry
+from tp_client import fetch_places, fetch_prices_for_dates
+from city_cache import lookup_cached_code, store_cached_code
+from city_index import resolve_city_offline, fuzzy_city_offline
+from user_cache import get_profile
+from cache import LRUCache
+
+async def get_iata_code(city_name: str):
+    code = resolve_city_offline(city_name)
+    if code:
+        return code
+    found, code = await lookup_cached_code(city_name)
+    if found:
+        return code
+    data = await fetch_places(city_name)
+    if data is None:
+        return fuzzy_city_offline(city_name)
+    code = data[0]['code'] if data else fuzzy_city_offline(city_name)
+    await store_cached_code(city_name, code)
+    return code
+
+QUOTE_CACHE_TTL = 10 * 60
+QUOTE_CACHE_STALE_TTL = 30 * 60
+QUOTE_CACHE_SIZE = 2000
+QUOTE_PAGE_LIMIT = 30
+MONTH_PAGE_LIMIT = 1000
+MONTH_MAX_PAGES = 3
+
+quote_cache = LRUCache(maxsize=QUOTE_CACHE_SIZE, ttl=QUOTE_CACHE_TTL + QUOTE_CACHE_STALE_TTL)
+quote_stats = {"fresh": 0, "stale": 0, "miss": 0, "refreshes": 0, "errors": 0}
+_quote_refreshes = {}
+
+def quote_cache_key(origin, destination, departure_at, currency, direct=False):
+    return (origin.upper(), destination.upper(), departure_at, currency.lower(), bool(direct))
+
+def _page_items(data):
+    raw_data = data.get("data", [])
+    if isinstance(raw_data, dict):
+        return list(raw_data.values())
+    elif isinstance(raw_data, list):
+        return raw_data
+    return []
+
+async def _request_quotes(key):
+    origin, destination, departure_at, currency, direct = key
+    month_level = len(departure_at) == 7
+    limit = MONTH_PAGE_LIMIT if month_level else QUOTE_PAGE_LIMIT
+    max_pages = MONTH_MAX_PAGES if month_level else 1
+    quotes = []
+    for page in range(1, max_pages + 1):
+        params = {
+            'origin': origin,
+            'destination': destination,
+            'departure_at': departure_at,
+            'one_way': 'true',
+            'direct': str(direct).lower(),
+            'currency': currency,
+            'sorting': 'price',
+            'limit': limit,
+            'page': page,
+            'token': TP_API_TOKEN
+        }
+        data = await fetch_prices_for_dates(params)
+        if not isinstance(data, dict) or not data.get("success", True):
+            return None
+        items = _page_items(data)
+        quotes.extend(items)
+        if len(items) < limit:
+            break
+    return quotes
+
+async def _refresh_quotes(key):
+    quote_stats["refreshes"] += 1
+    quotes = await _request_quotes(key)
+    if quotes is None:
+        quote_stats["errors"] += 1
         return None
-    results = data["data"]
-    results.sort(key=lambda x: x["departure_at"])
-    flag = get_currency_flag(currency)
+    quote_cache.set(key, (time.monotonic(), quotes))
+    return quotes
+
+def _schedule_quote_refresh(key):
+    if key in _quote_refreshes:
+        return
+    task = asyncio.create_task(_refresh_quotes(key))
+    _quote_refreshes[key] = task
+    task.add_done_callback(lambda _: _quote_refreshes.pop(key, None))
+
+async def get_quotes(origin, destination, departure_at, currency, direct=False):
+    if not origin or not destination:
+        return []
+    key = quote_cache_key(origin, destination, departure_at, currency, direct)
+    entry = quote_cache.get(key)
+    if entry is not None:
+        fetched_at, quotes = entry
+        if time.monotonic() - fetched_at < QUOTE_CACHE_TTL:
+            quote_stats["fresh"] += 1
+        else:
+            quote_stats["stale"] += 1
+            _schedule_quote_refresh(key)
+        return quotes
+    quote_stats["miss"] += 1
+    return await _refresh_quotes(key) or []
+
+def quote_cache_stats():
+    served = quote_stats["fresh"] + quote_stats["stale"]
+    total = served + quote_stats["miss"]
+    return {
+        **quote_stats,
+        "size": len(quote_cache),
+        "evictions": quote_cache.evictions,
+        "hit_rate": round(served / total, 3) if total else 0.0,
+    }
+
+SAVED_RESULTS_LIMIT = 5
+RENDERED_RESULTS_LIMIT = 5
+
+def build_aviasales_link(origin_code, departure_date, dest_code, passengers=1):
+    return f"https://www.aviasales.ru/search/{origin_code}{departure_date.strftime('%d%m')}{dest_code}{passengers}"
+
+def normalize_quotes(items):
+    quotes = []
+    for item in items:
+        try:
+            departure_date = datetime.date.fromisoformat(item.get("departure_at", "")[:10])
+        except (TypeError, ValueError):
+            logging.warning(f"❗ Некорректная дата вылета в ответе API: {item.get('departure_at')}")
+            continue
+        quotes.append({
+            "departure_date": departure_date,
+            "price": item.get("price", 0),
+            "airline": item.get("airline") or "N/A",
+        })
+    return quotes
+
+async def get_ticket_price(origin, destination, requested_date=None, currency="rub", direct=False):
+    departure_at = requested_date or datetime.date.today().strftime('%Y-%m')
+    quotes = await get_quotes(origin, destination, departure_at, currency, direct)
+    return normalize_quotes(quotes)
+
+async def search_with_fallback(origin, destination, requested_date, currency, direct=False):
+    quotes = await get_ticket_price(origin, destination, requested_date, currency, direct)
+    if not quotes and direct:
+        return await get_ticket_price(origin, destination, requested_date, currency, False), False
+    return quotes, direct
+
+async def get_quotes_by_day(origin, destination, dates, currency, direct=False):
+    months = defaultdict(set)
+    for day in dates:
+        months[day.strftime('%Y-%m')].add(day)
+    month_quotes = await asyncio.gather(
+        *(get_quotes(origin, destination, month, currency, direct) for month in months)
+    )
+    by_day = {day: [] for day in dates}
+    for quotes in month_quotes:
+        for quote in normalize_quotes(quotes):
+            if quote["departure_date"] in by_day:
+                by_day[quote["departure_date"]].append(quote)
+    return by_day
+
+async def search_dates_with_fallback(origin, destination, dates, currency, direct=False):
+    by_day = await get_quotes_by_day(origin, destination, dates, currency, direct)
+    results = {day: (quotes, direct) for day, quotes in by_day.items()}
+    missing = [day for day, quotes in by_day.items() if not quotes]
+    if direct and missing:
+        fallback = await get_quotes_by_day(origin, destination, missing, currency, False)
+        results.update((day, (quotes, False)) for day, quotes in fallback.items())
+    return results
+
+def render_ticket_reply(quotes, origin, destination, origin_name, dest_name, currency="rub", lang="ru", passengers=1):
+    registry = get_registry()
+    flag = registry.currency_flag(currency)
     route_display = f"{origin_name.title()} → {dest_name.title()}"
     reply_text = f"🎯 {t('route_header', lang)} *{route_display}*\n\n"
-    for item in results[:5]:
-        price = item.get("price", 0)
-        airline_code = item.get("airline", "неизв.")
-        session = SessionLocal()
-        airline_entry = session.query(Airline).filter_by(code=airline_code).first()
-        airline = airline_entry.name_ru if lang == "ru" and airline_entry else airline_code
-        session.close()
-        departure_raw = item["departure_at"][:10]
-        departure_time = datetime.datetime.strptime(departure_raw, "%Y-%m-%d").strftime("%d-%m-%Y")
-        total_price = price * passengers
-        date_short = datetime.datetime.strptime(departure_raw, "%Y-%m-%d").strftime("%d%m")
-        aviasales_link = f"https://www.aviasales.ru/search/{origin}{date_short}{destination}{passengers}"
+    for quote in sorted(quotes, key=lambda q: q["departure_date"])[:RENDERED_RESULTS_LIMIT]:
+        airline = registry.airline_name(quote["airline"], lang)
+        total_price = quote["price"] * passengers
+        aviasales_link = build_aviasales_link(origin, quote["departure_date"], destination, passengers)
         reply_text += (
-            f"📅 *{departure_time}* — *{total_price} {currency} {flag}* (`{airline}`)\n"
+            f"📅 *{quote['departure_date'].strftime('%d-%m-%Y')}* — *{total_price} {currency} {flag}* (`{airline}`)\n"
             f"[🔗 {t('buy_button', lang)}]({aviasales_link})\n"
         )
     return reply_text
 
-def save_results_to_db(session, search_id, results, origin_code, dest_code, passengers, currency):
-    for item in results:
+def save_results_to_db(search, quotes, origin_code, dest_code, passengers, currency):
+    for quote in quotes[:SAVED_RESULTS_LIMIT]:
+        search.results.append(SearchResult(
+            airline_code=quote["airline"],
+            departure_date=quote["departure_date"],
+            price=quote["price"],
+            currency=currency.upper(),
+            link=build_aviasales_link(origin_code, quote["departure_date"], dest_code, passengers)
+        ))
+
+async def save_search_and_results(user_id, origin_city, dest_city, depart_date, passengers, currency, direct, quotes, origin_code, dest_code):
+    async with AsyncSessionLocal() as session:
         try:
-            departure_raw = item.get("departure_at", "")[:10]
-            departure_date_obj = datetime.datetime.strptime(departure_raw, "%Y-%m-%d").date()
-            price = item.get("price", 0)
-            airline_code = item.get("airline", "N/A")
-            date_short = departure_date_obj.strftime("%d%m")
-            link = f"https://www.aviasales.ru/search/{origin_code}{date_short}{dest_code}{passengers}"
-            session.add(SearchResult(
-                search_id=search_id,
-                airline_code=airline_code,
-                departure_date=departure_date_obj,
-                price=price,
-                currency=currency.upper(),
-                link=link
-            ))
+            search = SearchHistory(
+                user_id=user_id,
+                origin_city=origin_city,
+                destination_city=dest_city,
+                depart_date=depart_date,
+                passengers=passengers,
+                direct_only=direct
+            )
+            save_results_to_db(search, quotes, origin_code, dest_code, passengers, currency)
+            session.add(search)
+            await session.commit()
         except Exception as e:
-            logging.warning(f"❗ Ошибка при сохранении SearchResult: {e}")
-
-def save_search_and_results(user, origin_city, dest_city, depart_date, passengers, currency, direct, raw_data=None):
-    session = SessionLocal()
-    search = SearchHistory(
-        user_id=user.id,
-        origin_city=origin_city,
-        destination_city=dest_city,
-        depart_date=depart_date,
-        passengers=passengers,
-        direct_only=direct
-    )
-    session.add(search)
-    session.commit()
-    if raw_data is None:
-        origin_code = get_iata_code(origin_city)
-        dest_code = get_iata_code(dest_city)
-        raw_data = fetch_ticket_data(origin_code, dest_code, depart_date, currency, passengers, direct)
-    else:
-        origin_code = get_iata_code(origin_city)
-        dest_code = get_iata_code(dest_city)
-    if not isinstance(raw_data, list):
-        logging.warning(f"❌ fetch_ticket_data вернул {type(raw_data)}, ожидается список")
-        raw_data = []
-    save_results_to_db(
-        session=session,
-        search_id=search.id,
-        results=raw_data,
-        origin_code=origin_code,
-        dest_code=dest_code,
-        passengers=passengers,
-        currency=currency
-    )
-    session.commit()
-    session.close()
-
-def fetch_ticket_data(origin_code, dest_code, depart_date, currency, passengers=1, direct=False):
-    if isinstance(depart_date, datetime.datetime):
-        depart_date = depart_date.date().isoformat()
-    elif isinstance(depart_date, datetime.date):
-        depart_date = depart_date.isoformat()
-    elif not isinstance(depart_date, str):
-        logging.warning("❌ Неправильный тип даты")
-        return []
-    params = {
-        'origin': origin_code,
-        'destination': dest_code,
-        'departure_at': depart_date,
-        'currency': currency.lower(),
-        'limit': 5,
-        'token': TP_API_TOKEN
-    }
-    if direct:
-        params['direct'] = 'true'
-    try:
-        response = requests.get('https://api.travelpayouts.com/aviasales/v3/prices_for_dates', params=params)
-        if response.status_code != 200:
-            logging.warning(f"API вернул {response.status_code}: {response.text}")
-            return []
-        data = response.json()
-        raw_data = data.get("data", [])
-        if isinstance(raw_data, dict):
-            return list(raw_data.values())
-        elif isinstance(raw_data, list):
-            return raw_data
-        else:
-            return []
-    except Exception as e:
-        logging.warning(f"Ошибка запроса: {e}")
-        return []
+            await session.rollback()
+            logging.warning(f"❗ Ошибка при сохранении истории поиска: {e}")
+
+async def get_user_id(telegram_id):
+    profile = await get_profile(telegram_id)
+    return profile["id"] if profile else None
 
 async def process_selected_dates(update, context):
     data = context.user_data.get('calendar')
@@ -153,77 +229,38 @@ async def process_selected_dates(update, context):
     if not data['selected']:
         await update.effective_message.reply_text(t("calendar_no_dates", lang))
         return
-    origin_code = get_iata_code(origin_city)
-    dest_code = get_iata_code(dest_city)
+    origin_code = await get_iata_code(origin_city)
+    dest_code = await get_iata_code(dest_city)
     if not origin_code or not dest_code:
         await update.effective_message.reply_text(t("city_error", lang))
         return
     passengers = context.user_data.get("filters", {}).get("passengers", 1)
-    sorted_dates = sorted(data['selected'], key=lambda d: datetime.datetime.strptime(d, "%d-%m-%Y"))
+    direct = context.user_data.get("filters", {}).get("direct", False)
+    user_id = await get_user_id(update.effective_user.id)
+    today = datetime.date.today()
     found_any = False
     all_replies = ""
-    for d in sorted_dates:
+    future_dates = []
+    for d in sorted(data['selected'], key=lambda d: datetime.datetime.strptime(d, "%d-%m-%Y")):
+        parsed = datetime.datetime.strptime(d, "%d-%m-%Y").date()
+        if parsed < today:
+            all_replies += f"{t('past_date', lang)} ({parsed.strftime('%d-%m-%Y')})\n\n"
+        else:
+            future_dates.append(parsed)
+    results = await search_dates_with_fallback(origin_code, dest_code, future_dates, currency, direct)
+    for day in future_dates:
         try:
-            parsed = datetime.datetime.strptime(d, "%d-%m-%Y")
-            if parsed.date() < datetime.date.today():
-                all_replies += f"{t('past_date', lang)} ({parsed.strftime('%d-%m-%Y')})\n\n"
+            quotes, used_direct = results[day]
+            if not quotes:
                 continue
-            formatted = parsed.strftime("%Y-%m-%d")
-            direct = context.user_data.get("filters", {}).get("direct", False)
-            reply = get_ticket_price(origin_code, dest_code, origin_city, dest_city, formatted, currency, lang, passengers, direct=direct)
-            if not reply and direct:
-                alt_reply = get_ticket_price(origin_code, dest_code, origin_city, dest_city, formatted, currency, lang, passengers, direct=False)
-                if alt_reply:
-                    warning_text = t("no_direct_but_with_transfers", lang) + "\n"
-                    all_replies += warning_text + alt_reply + "\n\n"
-                    found_any = True
-                    session = SessionLocal()
-                    user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-                    session.close()
-                    if user:
-                        save_search_and_results(user, origin_city, dest_city, formatted, passengers, currency, False)
-                    continue
-            if reply:
-                all_replies += reply + "\n"
-                found_any = True
-                session = SessionLocal()
-                telegram_id = update.effective_user.id
-                user = session.query(User).filter_by(telegram_id=telegram_id).first()
-                if user:
-                    search = SearchHistory(
-                        user_id=user.id,
-                        origin_city=origin_city,
-                        destination_city=dest_city,
-                        depart_date=formatted,
-                        passengers=passengers,
-                        direct_only=direct
-                    )
-                    session.add(search)
-                    session.commit()
-                    results_raw = fetch_ticket_data(
-                        origin_code,
-                        dest_code,
-                        formatted,
-                        currency,
-                        passengers,
-                        direct
-                    )
-                    if not isinstance(results_raw, list):
-                        logging.warning(f"❌ fetch_ticket_data вернул {type(results_raw)}, ожидается список")
-                        results_raw = []
-                    save_results_to_db(
-                        session=session,
-                        search_id=search.id,
-                        results=results_raw,
-                        origin_code=origin_code,
-                        dest_code=dest_code,
-                        passengers=passengers,
-                        currency=currency
-                    )
-                    session.commit()
-                session.close()
+            if used_direct != direct:
+                all_replies += t("no_direct_but_with_transfers", lang) + "\n"
+            all_replies += render_ticket_reply(quotes, origin_code, dest_code, origin_city, dest_city, currency, lang, passengers) + "\n"
+            found_any = True
+            if user_id:
+                await save_search_and_results(user_id, origin_city, dest_city, day, passengers, currency, used_direct, quotes, origin_code, dest_code)
         except Exception as e:
-            logging.warning(f"Ошибка при обработке даты {d}: {e}")
+            logging.warning(f"Ошибка при обработке даты {day}: {e}")
             continue
     if passengers > 1 and found_any:
         all_replies += "\n" + t("multi_passenger_warning", lang)
@@ -0,0 +1,77 @@
+import logging
+import heapq
+import time
+
+FLOW_STATE_KEYS = ("calendar", "calendar_mode", "track", "track_mode", "track_awaiting", "awaiting_feedback")
+FLOW_STATE_TTL = 30 * 60
+IDLE_EVICT_AFTER = 2 * 60 * 60
+STATE_SWEEP_INTERVAL = 5 * 60
+STATE_REPORT_TOP = 5
+
+class StateLifecycleManager:
+    def __init__(self, application, flow_ttl=FLOW_STATE_TTL, idle_after=IDLE_EVICT_AFTER):
+        self.application = application
+        self.flow_ttl = flow_ttl
+        self.idle_after = idle_after
+        self.last_seen = {}
+        self.started_at = time.monotonic()
+        self.stats = {"expired_flows": 0, "evicted": 0, "sweeps": 0}
+
+    async def touch(self, update, context):
+        if update.effective_user:
+            self.last_seen[update.effective_user.id] = time.monotonic()
+
+    def idle_for(self, user_id, now):
+        return now - self.last_seen.get(user_id, self.started_at)
+
+    def expire_flows(self, now):
+        expired = []
+        for user_id, data in self.application.user_data.items():
+            if self.idle_for(user_id, now) >= self.flow_ttl and any(key in data for key in FLOW_STATE_KEYS):
+                for key in FLOW_STATE_KEYS:
+                    data.pop(key, None)
+                expired.append(user_id)
+        if expired:
+            self.application.mark_data_for_update_persistence(user_ids=expired)
+        return len(expired)
+
+    async def evict_idle(self, now):
+        idle = [user_id for user_id in self.application.user_data if self.idle_for(user_id, now) >= self.idle_after]
+        if not idle:
+            return 0
+        persistence = self.application.persistence
+        if persistence is not None:
+            self.application.mark_data_for_update_persistence(user_ids=idle)
+            await self.application.update_persistence()
+            await persistence.flush()
+            idle = [user_id for user_id in idle if self.idle_for(user_id, time.monotonic()) >= self.idle_after]
+            persistence.mark_evicted(idle)
+        for user_id in idle:
+            self.application.drop_user_data(user_id)
+            self.last_seen.pop(user_id, None)
+        if persistence is not None:
+            await self.application.update_persistence()
+        return len(idle)
+
+    async def sweep(self):
+        now = time.monotonic()
+        expired = self.expire_flows(now)
+        evicted = await self.evict_idle(now)
+        self.stats["expired_flows"] += expired
+        self.stats["evicted"] += evicted
+        self.stats["sweeps"] += 1
+        report = self.report()
+        logging.info(
+            f"🧺 Состояние пользователей: активных {report['resident_users']}, "
+            f"{report['total_bytes']} байт, сброшено сценариев {expired}, выгружено {evicted}"
+        )
+
+    def report(self, top=STATE_REPORT_TOP):
+        persistence = self.application.persistence
+        sizes = persistence.state_sizes if persistence is not None else {}
+        return {
+            **self.stats,
+            "resident_users": len(self.application.user_data),
+            "total_bytes": sum(sizes.values()),
+            "largest": heapq.nlargest(top, sizes.items(), key=lambda item: item[1]),
+        }
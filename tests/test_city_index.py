@@ -0,0 +1,21 @@
+from city_index import load_city_index
+
+index = load_city_index()
+
+def test_exact_and_inflected_names_resolve():
+    assert index.resolve("Москва") == "MOW"
+    assert index.resolve("в Казань") == "KZN"
+    assert index.resolve("из Новосибирска") == "OVB"
+
+def test_short_unknown_cities_are_not_matched_offline():
+    assert index.resolve("Орск") is None
+    assert index.resolve("Бари") is None
+    assert index.fuzzy("Орск") is None
+    assert index.fuzzy("Бари") is None
+
+def test_fuzzy_accepts_single_typo_in_long_names():
+    assert index.resolve("Новосибирк") is None
+    assert index.fuzzy("Новосибирк") == "OVB"
+
+def test_fuzzy_rejects_unmatched_typo():
+    assert index.fuzzy("Крокодилово") is None
@@ -0,0 +1,100 @@
+import logging
+import asyncio
+from urllib.parse import urlsplit
+import httpx
+from ratelimit import TokenBucket
+
+AUTOCOMPLETE_URL = 'https://autocomplete.travelpayouts.com/places2'
+PRICES_FOR_DATES_URL = 'https://api.travelpayouts.com/aviasales/v3/prices_for_dates'
+
+REQUEST_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 5.0
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 30.0
+
+HOST_RATE_LIMITS = {
+    'api.travelpayouts.com': (5.0, 10),
+    'autocomplete.travelpayouts.com': (10.0, 20),
+}
+DEFAULT_RATE_LIMIT = (5.0, 10)
+
+_client = None
+_rate_limiters = {}
+_inflight = {}
+singleflight_stats = {"leaders": 0, "coalesced": 0}
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY
+            )
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+def get_rate_limiter(url) -> TokenBucket:
+    host = urlsplit(url).hostname
+    limiter = _rate_limiters.get(host)
+    if limiter is None:
+        rate, capacity = HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+        limiter = _rate_limiters[host] = TokenBucket(rate, capacity)
+    return limiter
+
+async def _request_json(url, params, timeout=None):
+    await get_rate_limiter(url).acquire()
+    try:
+        response = await get_client().get(url, params=params, timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+    except httpx.TimeoutException:
+        logging.warning(f"⏱ Таймаут запроса к {url}")
+        return None
+    except httpx.HTTPError as e:
+        logging.warning(f"Ошибка запроса: {e}")
+        return None
+    if response.status_code != 200:
+        logging.warning(f"API вернул {response.status_code}: {response.text}")
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        logging.warning(f"❌ Некорректный JSON от {url}")
+        return None
+
+def _flight_key(url, params):
+    return (url, tuple(sorted((key, str(value)) for key, value in params.items())))
+
+async def get_json(url, params, timeout=None):
+    key = _flight_key(url, params)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_request_json(url, params, timeout))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+        singleflight_stats["leaders"] += 1
+    else:
+        singleflight_stats["coalesced"] += 1
+    return await asyncio.shield(task)
+
+def client_stats():
+    return {
+        **singleflight_stats,
+        "in_flight": len(_inflight),
+        "rate_limit_wait": {host: round(limiter.waited, 3) for host, limiter in _rate_limiters.items()},
+    }
+
+async def fetch_places(term, locale='ru', types='city', timeout=None):
+    params = {'term': term, 'locale': locale, 'types[]': types}
+    return await get_json(AUTOCOMPLETE_URL, params, timeout=timeout)
+
+async def fetch_prices_for_dates(params, timeout=None):
+    return await get_json(PRICES_FOR_DATES_URL, params, timeout=timeout)
@@ -0,0 +1,123 @@
+import logging
+import asyncio
+import datetime
+import heapq
+import itertools
+import time
+import zlib
+from db import AsyncSessionLocal
+from tracking import iter_active_routes, group_routes, route_pair, check_planned_groups
+
+TRACKING_INTERVAL = 30 * 60
+TRACKING_TICK = 60
+TICK_CAPACITY = 200
+
+class TrackingScheduler:
+    def __init__(self, bot, interval=TRACKING_INTERVAL, tick=TRACKING_TICK, capacity=TICK_CAPACITY):
+        self.bot = bot
+        self.tick_seconds = tick
+        self.slots = max(1, interval // tick)
+        self.capacity = capacity
+        self.plan = {}
+        self.queue = []
+        self.queued_keys = set()
+        self.tick_index = 0
+        self._seq = itertools.count()
+        self._lock = asyncio.Lock()
+        self.cycle = self._new_cycle()
+        self.stats = {
+            "planned_groups": 0, "checked_groups": 0, "timeouts": 0, "errors": 0, "skipped": 0,
+            "last_tick_duration": 0.0, "cycle_duration": 0.0, "cycle_routes": 0, "routes_per_sec": 0.0,
+        }
+
+    @staticmethod
+    def _new_cycle():
+        return {"routes": 0, "groups": 0, "timeouts": 0, "errors": 0, "duration": 0.0}
+
+    def _finish_cycle(self):
+        cycle, self.cycle = self.cycle, self._new_cycle()
+        if not cycle["groups"]:
+            return
+        duration = cycle["duration"]
+        routes_per_sec = round(cycle["routes"] / duration, 1) if duration else 0.0
+        self.stats.update(cycle_duration=round(duration, 3), cycle_routes=cycle["routes"], routes_per_sec=routes_per_sec)
+        logging.info(
+            f"✅ Проверка цен завершена за {duration:.1f} с: {cycle['routes']} отслеживаний "
+            f"в {cycle['groups']} запросах, {routes_per_sec} маршрутов/с, "
+            f"таймаутов {cycle['timeouts']}, ошибок {cycle['errors']}"
+        )
+
+    def slot_for(self, key):
+        return zlib.crc32(repr(key).encode("utf-8")) % self.slots
+
+    async def rebuild_plan(self):
+        plan = {}
+        codes = {}
+        routes = groups = 0
+        async with AsyncSessionLocal() as session:
+            async for chunk in iter_active_routes(session):
+                routes += len(chunk)
+                for key, routes_by_date in (await group_routes(chunk, codes)).items():
+                    slot_plan = plan.setdefault(self.slot_for(key), {})
+                    first, last = min(routes_by_date), max(routes_by_date)
+                    spec = slot_plan.get(key)
+                    if spec is None:
+                        spec = slot_plan[key] = {"pairs": set(), "first": first, "last": last}
+                        groups += 1
+                    spec["first"], spec["last"] = min(spec["first"], first), max(spec["last"], last)
+                    spec["pairs"].update(route_pair(route) for rs in routes_by_date.values() for route in rs)
+        self.plan = plan
+        self.stats["planned_groups"] = groups
+        logging.info(f"🗓 План проверки цен: {routes} отслеживаний, {groups} запросов в {self.slots} слотах")
+
+    def _enqueue(self, key, spec, due_at):
+        if key in self.queued_keys:
+            return
+        days_to_departure = (spec["first"] - datetime.date.today()).days
+        heapq.heappush(self.queue, (days_to_departure, due_at, next(self._seq), key, spec))
+        self.queued_keys.add(key)
+
+    def _take_batch(self):
+        batch = []
+        while self.queue and len(batch) < self.capacity:
+            _, _, _, key, spec = heapq.heappop(self.queue)
+            self.queued_keys.discard(key)
+            batch.append((key, spec))
+        return batch
+
+    async def tick(self):
+        if self._lock.locked():
+            self.stats["skipped"] += 1
+            logging.warning("⏭ Предыдущий слот проверки цен ещё выполняется, пропуск")
+            return
+        async with self._lock:
+            started = time.monotonic()
+            slot = self.tick_index % self.slots
+            if slot == 0:
+                self._finish_cycle()
+                await self.rebuild_plan()
+            self.tick_index += 1
+            for key, spec in self.plan.get(slot, {}).items():
+                self._enqueue(key, spec, started)
+            batch = self._take_batch()
+            routes, timeouts, errors = await check_planned_groups(self.bot, batch)
+            duration = time.monotonic() - started
+            for name, value in (("routes", routes), ("groups", len(batch)), ("timeouts", timeouts), ("errors", errors), ("duration", duration)):
+                self.cycle[name] += value
+            self.stats["checked_groups"] += len(batch)
+            self.stats["timeouts"] += timeouts
+            self.stats["errors"] += errors
+            self.stats["last_tick_duration"] = round(duration, 3)
+            if self.queue:
+                logging.info(f"⏳ Очередь проверки цен: {self.queue_depth()} запросов, отставание {self.lag():.0f} с")
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def lag(self):
+        if not self.queue:
+            return 0.0
+        return time.monotonic() - min(entry[1] for entry in self.queue)
+
+    def snapshot(self):
+        return {**self.stats, "queue_depth": self.queue_depth(), "lag": round(self.lag(), 1), "slot": self.tick_index % self.slots}
@@ -1,10 +1,40 @@
 import logging
+import asyncio
 import datetime
+from collections import defaultdict
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from db import SessionLocal
+from sqlalchemy import and_, func, or_, select, tuple_, update
+from db import AsyncSessionLocal
 from models import User, TrackedRoute, Notification
 from utils import t, build_tracking_settings_keyboard
-from search import get_iata_code, fetch_ticket_data
+from search import get_iata_code, get_quotes_by_day, build_aviasales_link
+from notifier import get_dispatcher
+from user_cache import get_profile
+from price_history import price_key, record_price, load_baselines, flush_price_snapshots
+
+TRACKER_CONCURRENCY = 10
+TRACKER_CHECK_TIMEOUT = 30
+ROUTE_CHUNK_SIZE = 1000
+GROUP_QUERY_BATCH = 50
+
+ROUTE_STATE_COLUMNS = (
+    TrackedRoute.id,
+    TrackedRoute.user_id,
+    TrackedRoute.origin_city,
+    TrackedRoute.destination_city,
+    TrackedRoute.depart_date,
+    TrackedRoute.currency,
+    TrackedRoute.notify_below_price,
+    TrackedRoute.price_drop_percent,
+    TrackedRoute.last_notified_price,
+    TrackedRoute.last_notified_percent,
+    TrackedRoute.last_checked_price,
+    User.telegram_id,
+    User.language,
+)
+
+def format_route_date(value):
+    return value.strftime("%d-%m-%Y") if value else "—"
 
 async def track_command(update, context):
     lang = context.user_data.get("lang", "ru")
@@ -39,13 +69,10 @@ async def track_callback(update, context):
         await save_tracked_route(update, context)
 
 async def save_tracked_route(update, context):
-    session = SessionLocal()
-    telegram_id = update.effective_user.id
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
     lang = context.user_data.get("lang", "ru")
-    if not user:
+    profile = await get_profile(update.effective_user.id)
+    if not profile:
         await update.effective_message.reply_text(t("user_not_found", lang))
-        session.close()
         return
     data = context.user_data.get("track", {})
     origin = data.get("origin")
@@ -57,44 +84,42 @@ async def save_tracked_route(update, context):
         dates = [data["date"]]
     elif data.get("selected_dates"):
         dates = data["selected_dates"]
-    for d in dates:
-        route = TrackedRoute(
-            user_id=user.id,
-            currency=user.currency,
-            origin_city=origin,
-            destination_city=dest,
-            depart_date=d,
-            notify_below_price=price,
-            price_drop_percent=percent,
-            active=True
-        )
-        session.add(route)
-    session.commit()
-    session.close()
+    async with AsyncSessionLocal() as session:
+        for d in dates:
+            route = TrackedRoute(
+                user_id=profile["id"],
+                currency=profile["currency"],
+                origin_city=origin,
+                destination_city=dest,
+                depart_date=datetime.datetime.strptime(d, "%d-%m-%Y").date(),
+                notify_below_price=price,
+                price_drop_percent=percent,
+                active=True
+            )
+            session.add(route)
+        await session.commit()
     msg = t("track_saved", lang, n=len(dates))
     await update.effective_message.reply_text(msg)
     context.user_data.pop("track", None)
 
 async def my_tracks(update, context):
     lang = context.user_data.get("lang", "ru")
-    session = SessionLocal()
-    telegram_id = update.effective_user.id
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if not user:
+    profile = await get_profile(update.effective_user.id)
+    if not profile:
         await update.message.reply_text(t("user_not_found", lang))
-        session.close()
         return
-    tracks = session.query(TrackedRoute).filter_by(user_id=user.id, active=True).all()
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(TrackedRoute).filter_by(user_id=profile["id"], active=True))
+        tracks = result.scalars().all()
     if not tracks:
         await update.message.reply_text(t("no_active_tracks", lang))
-        session.close()
         return
     for route in tracks:
         text = (
             f"📌 *{route.origin_city.title()} → {route.destination_city.title()}*"
-            f"\n📅 {route.depart_date}"
+            f"\n📅 {format_route_date(route.depart_date)}"
         )
-        currency = route.currency or user.currency
+        currency = route.currency or profile["currency"]
         if route.notify_below_price:
             price_label = t("track_price_label", lang)
             text += f"\n💰 {price_label} ≤ {route.notify_below_price} {currency}"
@@ -105,144 +130,252 @@ async def my_tracks(update, context):
             InlineKeyboardButton(t("untrack_button", lang), callback_data=f"untrack_{route.id}")
         ]])
         await update.message.reply_text(text, parse_mode='Markdown', reply_markup=keyboard)
-    session.close()
 
 async def all_tracks(update, context):
     lang = context.user_data.get("lang", "ru")
-    session = SessionLocal()
-    telegram_id = update.effective_user.id
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if not user:
+    profile = await get_profile(update.effective_user.id)
+    if not profile:
         await update.message.reply_text(t("user_not_found", lang))
-        session.close()
         return
-    tracks = session.query(TrackedRoute).filter_by(user_id=user.id).order_by(TrackedRoute.created_at.desc()).limit(5).all()
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(TrackedRoute).filter_by(user_id=profile["id"]).order_by(TrackedRoute.created_at.desc()).limit(5)
+        )
+        tracks = result.scalars().all()
     if not tracks:
         await update.message.reply_text(t("no_all_tracks", lang))
-        session.close()
         return
     for route in tracks:
         status = t("status_active", lang) if route.active else t("status_cancelled", lang)
         text = (
             f"📌 *{route.origin_city.title()} → {route.destination_city.title()}*"
-            f"\n📅 {route.depart_date}"
+            f"\n📅 {format_route_date(route.depart_date)}"
         )
-        currency = route.currency or user.currency
+        currency = route.currency or profile["currency"]
         if route.notify_below_price:
             text += f"\n💰 ≤ {route.notify_below_price} {currency}"
         if route.price_drop_percent:
             text += f"\n📉 -{route.price_drop_percent}%"
         text += f"\n{status}"
         await update.message.reply_text(text, parse_mode='Markdown')
-    session.close()
 
 async def untrack_callback(update, context):
     query = update.callback_query
     await query.answer()
     lang = context.user_data.get("lang", "ru")
     route_id = int(query.data.split("_")[1])
-    session = SessionLocal()
-    telegram_id = update.effective_user.id
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    route = session.query(TrackedRoute).filter_by(id=route_id, user_id=user.id, active=True).first()
-    if route:
-        route.active = False
-        session.commit()
+    profile = await get_profile(update.effective_user.id)
+    cancelled = False
+    if profile:
+        async with AsyncSessionLocal() as session:
+            cancelled = (await session.execute(
+                update(TrackedRoute)
+                .filter_by(id=route_id, user_id=profile["id"], active=True)
+                .values(active=False)
+            )).rowcount > 0
+            await session.commit()
+    if cancelled:
         await query.edit_message_text(t("untrack_cancelled", lang))
     else:
         await query.edit_message_text(t("untrack_not_found", lang))
-    session.close()
-
-async def send_notification(bot, user, route: TrackedRoute, message_text: str, reply_markup=None):
-    session = SessionLocal()
-    notification = Notification(
-        user_id=user.id,
-        route_id=route.id,
-        message=message_text
-    )
-    session.add(notification)
-    session.commit()
-    session.close()
+
+async def send_notification(bot, route, message_text: str, reply_markup=None):
+    dispatcher = get_dispatcher()
+    if dispatcher and dispatcher.running:
+        dispatcher.enqueue(route["user_id"], route["telegram_id"], route["id"], message_text, reply_markup)
+        return
+    async with AsyncSessionLocal() as session:
+        session.add(Notification(
+            user_id=route["user_id"],
+            route_id=route["id"],
+            message=message_text
+        ))
+        await session.commit()
     try:
         await bot.send_message(
-            chat_id=user.telegram_id,
+            chat_id=route["telegram_id"],
             text=message_text,
             parse_mode='Markdown',
             reply_markup=reply_markup
         )
     except Exception as e:
-        print(t("notification_error", user.language, error=str(e)))
+        print(t("notification_error", route["language"], error=str(e)))
+
+def _route_state_query(date_from=None, date_to=None):
+    query = (
+        select(*ROUTE_STATE_COLUMNS)
+        .join(User, User.id == TrackedRoute.user_id)
+        .filter(TrackedRoute.active.is_(True), TrackedRoute.depart_date >= (date_from or datetime.date.today()))
+    )
+    if date_to is not None:
+        query = query.filter(TrackedRoute.depart_date <= date_to)
+    return query
+
+async def iter_active_routes(session, chunk_size=ROUTE_CHUNK_SIZE, date_from=None, date_to=None):
+    last_id = 0
+    while True:
+        result = await session.execute(
+            _route_state_query(date_from, date_to)
+            .filter(TrackedRoute.id > last_id)
+            .order_by(TrackedRoute.id)
+            .limit(chunk_size)
+        )
+        rows = result.mappings().all()
+        if not rows:
+            return
+        yield [dict(row) for row in rows]
+        last_id = rows[-1]["id"]
+
+def route_pair(route):
+    return (route["origin_city"], route["destination_city"], route["currency"] or "RUB")
 
-async def check_prices_for_all(bot):
-    session = SessionLocal()
-    routes = session.query(TrackedRoute).filter_by(active=True).all()
+def _planned_routes_query(planned):
+    pair_columns = tuple_(TrackedRoute.origin_city, TrackedRoute.destination_city, func.coalesce(TrackedRoute.currency, "RUB"))
+    return _route_state_query().filter(or_(*(
+        and_(pair_columns.in_(list(spec["pairs"])), TrackedRoute.depart_date.between(spec["first"], spec["last"]))
+        for _, spec in planned
+    )))
+
+async def iter_planned_routes(session, planned, chunk_size=ROUTE_CHUNK_SIZE, batch=GROUP_QUERY_BATCH):
+    for start in range(0, len(planned), batch):
+        query = _planned_routes_query(planned[start:start + batch])
+        last = (datetime.date.min, 0)
+        while True:
+            result = await session.execute(
+                query
+                .filter(tuple_(TrackedRoute.depart_date, TrackedRoute.id) > tuple_(*last))
+                .order_by(TrackedRoute.depart_date, TrackedRoute.id)
+                .limit(chunk_size)
+            )
+            rows = result.mappings().all()
+            if rows:
+                yield [dict(row) for row in rows]
+            if len(rows) < chunk_size:
+                break
+            last = (rows[-1]["depart_date"], rows[-1]["id"])
+
+async def apply_route_updates(session, updates):
+    if updates:
+        await session.execute(update(TrackedRoute), updates)
+    await session.commit()
+
+def route_group_key(origin_code, dest_code, depart_date, currency):
+    return (origin_code, dest_code, depart_date.strftime("%Y-%m"), (currency or "RUB").upper())
+
+async def group_routes(routes, codes=None):
+    codes = {} if codes is None else codes
+    groups = defaultdict(lambda: defaultdict(list))
     for route in routes:
-        user = session.query(User).filter_by(id=route.user_id).first()
-        if not user:
-            continue
-        if isinstance(route.depart_date, datetime.date):
-            depart_str = route.depart_date.isoformat()
-        elif isinstance(route.depart_date, str):
-            try:
-                parsed_date = datetime.datetime.strptime(route.depart_date, "%d-%m-%Y")
-                depart_str = parsed_date.strftime("%Y-%m-%d")
-            except ValueError:
-                logging.warning(f"❌ Невозможно преобразовать дату: {route.depart_date}")
-                continue
-        else:
-            logging.warning(f"⚠️ Неподдерживаемый формат даты: {route.depart_date}")
+        depart_date = route["depart_date"]
+        for city in (route["origin_city"], route["destination_city"]):
+            if city not in codes:
+                codes[city] = await get_iata_code(city)
+        origin_code, dest_code = codes[route["origin_city"]], codes[route["destination_city"]]
+        if not origin_code or not dest_code:
             continue
-        results = fetch_ticket_data(
-            get_iata_code(route.origin_city),
-            get_iata_code(route.destination_city),
-            depart_str,
-            route.currency,
-            passengers=1,
-            direct=False
+        groups[route_group_key(origin_code, dest_code, depart_date, route["currency"])][depart_date].append(route)
+    return groups
+
+def evaluate_route_price(route, current_price, baseline=None):
+    previous_price = baseline or route["last_checked_price"] or current_price
+    should_notify = False
+    if route["notify_below_price"] and current_price <= route["notify_below_price"]:
+        should_notify = True
+    if route["price_drop_percent"]:
+        drop = (previous_price - current_price) / previous_price * 100
+        if drop >= route["price_drop_percent"]:
+            if not route["last_notified_percent"] or drop > route["last_notified_percent"]:
+                should_notify = True
+                route["last_notified_percent"] = int(drop)
+    return should_notify and current_price != route["last_notified_price"]
+
+def build_route_notification(route, current_price, origin_code, dest_code, depart_date):
+    lang = route["language"]
+    triggers = []
+    if route["notify_below_price"] is not None:
+        triggers.append(t("notification_price_condition", lang, price=route["notify_below_price"]))
+    if route["price_drop_percent"] is not None:
+        triggers.append(t("notification_percent_condition", lang, percent=route["price_drop_percent"]))
+    trigger_text = " и ".join(triggers) if lang == "ru" else ", ".join(triggers)
+    trigger_info = f" ({trigger_text})" if triggers else ""
+    message = t(
+        "notification_text",
+        lang,
+        origin=route["origin_city"].title(),
+        destination=route["destination_city"].title(),
+        date=format_route_date(route["depart_date"]),
+        price=current_price,
+        currency=route["currency"],
+        condition=trigger_info,
+    )
+    aviasales_url = build_aviasales_link(origin_code, depart_date, dest_code)
+    buttons = [
+        [InlineKeyboardButton(t("buy_button", lang), url=aviasales_url)],
+        [InlineKeyboardButton(t("stop_tracking", lang), callback_data=f"untrack_{route['id']}")]
+    ]
+    return message, InlineKeyboardMarkup(buttons)
+
+async def check_route_group(bot, key, routes_by_date, semaphore, updates, baselines):
+    origin_code, dest_code, _, currency = key
+    async with semaphore:
+        quotes_by_day = await asyncio.wait_for(
+            get_quotes_by_day(origin_code, dest_code, list(routes_by_date), currency),
+            TRACKER_CHECK_TIMEOUT
         )
-        if not results:
+    for depart_date, routes in routes_by_date.items():
+        quotes = quotes_by_day.get(depart_date)
+        if not quotes:
             continue
-        current_price = min(item.get("price", 0) for item in results)
-        previous_price = route.last_checked_price or current_price
-        should_notify = False
-        if route.notify_below_price and current_price <= route.notify_below_price:
-            should_notify = True
-        if route.price_drop_percent:
-            drop = (previous_price - current_price) / previous_price * 100
-            if drop >= route.price_drop_percent:
-                if not route.last_notified_percent or drop > route.last_notified_percent:
-                    should_notify = True
-                    route.last_notified_percent = int(drop)
-        if should_notify:
-            if current_price == route.last_notified_price:
-                continue
-            triggers = []
-            if route.notify_below_price is not None:
-                triggers.append(t("notification_price_condition", user.language, price=route.notify_below_price))
-            if route.price_drop_percent is not None:
-                triggers.append(t("notification_percent_condition", user.language, percent=route.price_drop_percent))
-            trigger_text = " и ".join(triggers) if user.language == "ru" else ", ".join(triggers)
-            trigger_info = f" ({trigger_text})" if triggers else ""
-            message = t(
-                "notification_text",
-                user.language,
-                origin=route.origin_city.title(),
-                destination=route.destination_city.title(),
-                date=route.depart_date,
-                price=current_price,
-                currency=route.currency,
-                condition=trigger_info,
-            )
-            origin_code = get_iata_code(route.origin_city)
-            dest_code = get_iata_code(route.destination_city)
-            date_short = datetime.datetime.strptime(route.depart_date, "%d-%m-%Y").strftime("%d%m")
-            aviasales_url = f"https://www.aviasales.ru/search/{origin_code}{date_short}{dest_code}1"
-            buttons = [
-                [InlineKeyboardButton(t("buy_button", user.language), url=aviasales_url)],
-                [InlineKeyboardButton(t("stop_tracking", user.language), callback_data=f"untrack_{route.id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(buttons)
-            await send_notification(bot, user, route, message, reply_markup=reply_markup)
-            route.last_notified_price = current_price
-    session.commit()
-    session.close()
+        current_price = min(quote["price"] for quote in quotes)
+        key = price_key(origin_code, dest_code, depart_date, currency)
+        record_price(key, current_price)
+        baseline = baselines.get(key, {}).get("avg")
+        for route in routes:
+            if evaluate_route_price(route, current_price, baseline):
+                message, reply_markup = build_route_notification(route, current_price, origin_code, dest_code, depart_date)
+                await send_notification(bot, route, message, reply_markup=reply_markup)
+                route["last_notified_price"] = current_price
+            route["last_checked_price"] = current_price
+            updates.append({
+                "id": route["id"],
+                "last_checked_price": route["last_checked_price"],
+                "last_notified_price": route["last_notified_price"],
+                "last_notified_percent": route["last_notified_percent"],
+            })
+
+async def run_group_checks(bot, groups, updates):
+    baselines = await load_baselines([
+        price_key(origin_code, dest_code, day, currency)
+        for (origin_code, dest_code, _, currency), routes_by_date in groups.items() for day in routes_by_date
+    ])
+    semaphore = asyncio.Semaphore(TRACKER_CONCURRENCY)
+    outcomes = await asyncio.gather(
+        *(check_route_group(bot, key, routes_by_date, semaphore, updates, baselines) for key, routes_by_date in groups.items()),
+        return_exceptions=True
+    )
+    timeouts = sum(isinstance(o, asyncio.TimeoutError) for o in outcomes)
+    errors = [o for o in outcomes if isinstance(o, Exception) and not isinstance(o, asyncio.TimeoutError)]
+    for error in errors:
+        logging.warning(f"❗ Ошибка при проверке маршрута: {error}")
+    return timeouts, len(errors)
+
+async def check_planned_groups(bot, planned):
+    if not planned:
+        return 0, 0, 0
+    keys_by_pair = {(*pair, key[2]): key for key, spec in planned for pair in spec["pairs"]}
+    routes = timeouts = errors = 0
+    async with AsyncSessionLocal() as session:
+        async for chunk in iter_planned_routes(session, planned):
+            groups = defaultdict(lambda: defaultdict(list))
+            for route in chunk:
+                key = keys_by_pair.get((*route_pair(route), route["depart_date"].strftime("%Y-%m")))
+                if key is not None:
+                    groups[key][route["depart_date"]].append(route)
+            updates = []
+            chunk_timeouts, chunk_errors = await run_group_checks(bot, groups, updates)
+            await apply_route_updates(session, updates)
+            routes += len(chunk)
+            timeouts += chunk_timeouts
+            errors += chunk_errors
+    await flush_price_snapshots()
+    return routes, timeouts, errors
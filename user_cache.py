@@ -0,0 +1,44 @@
+from sqlalchemy import select
+from db import AsyncSessionLocal, upsert_user
+from models import User
+from cache import LRUCache
+
+PROFILE_CACHE_SIZE = 10000
+PROFILE_TTL = 30 * 60
+
+PROFILE_COLUMNS = (
+    User.id,
+    User.telegram_id,
+    User.language,
+    User.currency,
+    User.timezone,
+    User.passengers_default,
+    User.direct_only_default,
+)
+
+profile_cache = LRUCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_TTL)
+
+def _profile_from_user(user):
+    return {column.key: getattr(user, column.key) for column in PROFILE_COLUMNS}
+
+async def get_profile(telegram_id):
+    profile = profile_cache.get(telegram_id)
+    if profile is not None:
+        return profile
+    async with AsyncSessionLocal() as session:
+        row = (await session.execute(select(*PROFILE_COLUMNS).filter_by(telegram_id=telegram_id))).mappings().first()
+    if row is None:
+        return None
+    profile = dict(row)
+    profile_cache.set(telegram_id, profile)
+    return profile
+
+async def update_profile(telegram_id, defaults=None, **fields):
+    profile_cache.pop(telegram_id)
+    user = await upsert_user(telegram_id, defaults, **fields)
+    profile = _profile_from_user(user)
+    profile_cache.set(telegram_id, profile)
+    return profile
+
+def profile_cache_stats():
+    return profile_cache.stats()
@@ -1,6 +1,17 @@
+import logging
+import datetime
+import hashlib
+import json
+from collections import defaultdict
+from functools import wraps
+from string import Formatter
+from types import MappingProxyType
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import insert, update
 from db import SessionLocal
-from models import Currency, Airline, Translation
+from models import Currency, Airline, Translation, SeedVersion
+from cache import LRUCache
+from reference_data import get_registry, refresh_registry, registry_version
 
 API_TOKEN = 'Здесь мой апи ключ для телеграм-бота'
 TP_API_TOKEN = 'Здесь мой апи ключ авиасейлс'
@@ -189,21 +200,89 @@ translations = {
     }
 }
 
-translation_cache = {}
+_formatter = Formatter()
+CONVERSIONS = {"s": str, "r": repr, "a": ascii}
+
+class Template:
+    __slots__ = ("text", "parts", "simple")
+
+    def __init__(self, text):
+        self.text = text
+        try:
+            parts = tuple(_formatter.parse(text))
+        except ValueError:
+            logging.warning(f"❗ Некорректный шаблон перевода: {text!r}")
+            self.parts, self.simple = None, True
+            return
+        self.simple = all(
+            field is None or (field.isidentifier() and "{" not in spec)
+            for _, field, spec, _ in parts
+        )
+        self.parts = None if all(field is None for _, field, _, _ in parts) else parts
+        if self.parts is None:
+            self.text = "".join(literal for literal, _, _, _ in parts)
+
+    def render(self, kwargs):
+        if self.parts is None:
+            return self.text
+        if not self.simple:
+            return self.text.format(**kwargs)
+        out = []
+        for literal, field, spec, conversion in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = kwargs[field]
+                if conversion:
+                    value = CONVERSIONS[conversion](value)
+                out.append(format(value, spec))
+        return "".join(out)
+
+def _flatten_translations(source):
+    for lang, entries in source.items():
+        for key, value in entries.items():
+            if isinstance(value, list):
+                for idx, item in enumerate(value):
+                    yield lang, f"{key}_{idx}", item
+            else:
+                yield lang, key, value
+
+def load_translation_catalog(include_db=True):
+    catalog = defaultdict(dict)
+    for lang, key, value in _flatten_translations(translations):
+        catalog[lang][key] = value
+    if include_db:
+        session = SessionLocal()
+        for key, lang, value in session.query(Translation.key, Translation.lang, Translation.value):
+            if value is not None:
+                catalog[lang][key] = value
+        session.close()
+    return MappingProxyType({
+        lang: MappingProxyType({key: Template(value) for key, value in entries.items()})
+        for lang, entries in catalog.items()
+    })
+
+_catalog = None
+
+def get_translation_catalog():
+    global _catalog
+    if _catalog is None:
+        _catalog = load_translation_catalog()
+        logging.info(f"🌐 Загружено переводов: {sum(len(entries) for entries in _catalog.values())}")
+    return _catalog
+
+def reload_translations():
+    global _catalog
+    _catalog = load_translation_catalog()
+    invalidate_keyboards()
+    return _catalog
+
+_EMPTY = MappingProxyType({})
 
 def t(key, lang="ru", **kwargs):
-    cached = translation_cache.get((key, lang))
-    if cached:
-        return cached.format(**kwargs)
-    session = SessionLocal()
-    entry = session.query(Translation).filter_by(key=key, lang=lang).first()
-    session.close()
-    if entry:
-        translation_cache[(key, lang)] = entry.value
-        return entry.value.format(**kwargs)
-    fallback = translations.get(lang, {}).get(key, key)
-    translation_cache[(key, lang)] = fallback
-    return fallback.format(**kwargs)
+    template = (_catalog or get_translation_catalog()).get(lang, _EMPTY).get(key)
+    if template is None:
+        return key
+    return template.render(kwargs)
 
 def plural_passenger(count, lang):
     if lang == "ru":
@@ -215,68 +294,110 @@ def plural_passenger(count, lang):
             return "пассажиров"
     return "passenger" if count == 1 else "passengers"
 
-def fill_currencies():
+CURRENCIES = [
+    {"code": "RUB", "name": "Russian Ruble", "symbol": "₽", "flag": "🇷🇺"},
+    {"code": "USD", "name": "US Dollar", "symbol": "$", "flag": "🇺🇸"},
+    {"code": "EUR", "name": "Euro", "symbol": "€", "flag": "🇪🇺"},
+    {"code": "GBP", "name": "British Pound", "symbol": "£", "flag": "🇬🇧"},
+    {"code": "KZT", "name": "Kazakh Tenge", "symbol": "₸", "flag": "🇰🇿"},
+    {"code": "CNY", "name": "Chinese Yuan", "symbol": "¥", "flag": "🇨🇳"},
+]
+
+AIRLINES = [
+    {"code": "DP", "name_ru": "Победа", "name_en": "Pobeda"},
+    {"code": "SU", "name_ru": "Аэрофлот", "name_en": "Aeroflot"},
+    {"code": "S7", "name_ru": "S7 Airlines", "name_en": "S7 Airlines"},
+    {"code": "UT", "name_ru": "ЮТэйр", "name_en": "UTair"},
+    {"code": "U6", "name_ru": "Уральские авиалинии", "name_en": "Ural Airlines"},
+]
+
+def seed_digest(rows):
+    payload = json.dumps(rows, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def seed_table(model, rows, key_columns, name=None, update_existing=True):
+    name = name or model.__tablename__
+    digest = seed_digest(rows)
     session = SessionLocal()
-    currencies = [
-        {"code": "RUB", "name": "Russian Ruble", "symbol": "₽", "flag": "🇷🇺"},
-        {"code": "USD", "name": "US Dollar", "symbol": "$", "flag": "🇺🇸"},
-        {"code": "EUR", "name": "Euro", "symbol": "€", "flag": "🇪🇺"},
-        {"code": "GBP", "name": "British Pound", "symbol": "£", "flag": "🇬🇧"},
-        {"code": "KZT", "name": "Kazakh Tenge", "symbol": "₸", "flag": "🇰🇿"},
-        {"code": "CNY", "name": "Chinese Yuan", "symbol": "¥", "flag": "🇨🇳"},
-    ]
-    for c in currencies:
-        if not session.query(Currency).filter_by(code=c["code"]).first():
-            session.add(Currency(**c))
-    session.commit()
-    session.close()
+    try:
+        version = session.get(SeedVersion, name)
+        if version is not None and version.digest == digest:
+            return 0
+        pk = [column.key for column in model.__mapper__.primary_key]
+        columns = [*rows[0], *(column for column in pk if column not in rows[0])]
+        existing = {
+            tuple(getattr(row, column) for column in key_columns): row
+            for row in session.query(*(getattr(model, column) for column in columns))
+        }
+        inserts, updates = [], []
+        for row in rows:
+            current = existing.get(tuple(row[column] for column in key_columns))
+            if current is None:
+                inserts.append(row)
+            elif update_existing and any(getattr(current, column) != value for column, value in row.items()):
+                updates.append({**{column: getattr(current, column) for column in pk}, **row})
+        if inserts:
+            session.execute(insert(model), inserts)
+        if updates:
+            session.execute(update(model), updates)
+        session.merge(SeedVersion(name=name, digest=digest, updated_at=datetime.datetime.utcnow()))
+        session.commit()
+        logging.info(f"🌱 {name}: добавлено {len(inserts)}, обновлено {len(updates)}")
+        return len(inserts) + len(updates)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def fill_currencies():
+    changed = seed_table(Currency, CURRENCIES, ("code",))
+    if changed:
+        refresh_registry()
+    return changed
 
 def fill_airlines():
-    session = SessionLocal()
-    airlines = [
-        {"code": "DP", "name_ru": "Победа", "name_en": "Pobeda"},
-        {"code": "SU", "name_ru": "Аэрофлот", "name_en": "Aeroflot"},
-        {"code": "S7", "name_ru": "S7 Airlines", "name_en": "S7 Airlines"},
-        {"code": "UT", "name_ru": "ЮТэйр", "name_en": "UTair"},
-        {"code": "U6", "name_ru": "Уральские авиалинии", "name_en": "Ural Airlines"},
-    ]
-    for a in airlines:
-        if not session.query(Airline).filter_by(code=a["code"]).first():
-            session.add(Airline(**a))
-    session.commit()
-    session.close()
+    changed = seed_table(Airline, AIRLINES, ("code",))
+    if changed:
+        refresh_registry()
+    return changed
 
 def fill_translations():
-    session = SessionLocal()
-    for lang, entries in translations.items():
-        for key, value in entries.items():
-            if isinstance(value, list):
-                for idx, item in enumerate(value):
-                    compound_key = f"{key}_{idx}"
-                    if not session.query(Translation).filter_by(key=compound_key, lang=lang).first():
-                        session.add(Translation(key=compound_key, lang=lang, value=item))
-            else:
-                if not session.query(Translation).filter_by(key=key, lang=lang).first():
-                    session.add(Translation(key=key, lang=lang, value=value))
-    session.commit()
-    session.close()
+    rows = [{"key": key, "lang": lang, "value": value} for lang, key, value in _flatten_translations(translations)]
+    changed = seed_table(Translation, rows, ("key", "lang"), update_existing=False)
+    if changed and _catalog is not None:
+        reload_translations()
+    return changed
 
-def get_currency_flag(code: str) -> str:
-    session = SessionLocal()
-    currency = session.query(Currency).filter_by(code=code.upper()).first()
-    session.close()
-    return currency.flag if currency else ""
+KEYBOARD_CACHE_SIZE = 2048
+
+keyboard_cache = LRUCache(maxsize=KEYBOARD_CACHE_SIZE)
+
+def cached_keyboard(builder):
+    @wraps(builder)
+    def wrapper(*state):
+        key = (builder.__name__, *state)
+        markup = keyboard_cache.get(key)
+        if markup is None:
+            markup = builder(*state)
+            keyboard_cache.set(key, markup)
+        return markup
+    return wrapper
+
+def invalidate_keyboards():
+    keyboard_cache.clear()
 
 def build_currency_inline_keyboard():
-    session = SessionLocal()
-    currencies = session.query(Currency).all()
-    session.close()
+    return _currency_keyboard(registry_version())
+
+@cached_keyboard
+def _currency_keyboard(version):
     keyboard = []
     row = []
-    for i, c in enumerate(currencies, start=1):
+    for i, c in enumerate(get_registry().currencies.values(), start=1):
         button = InlineKeyboardButton(
-            text=f"{c.flag} {c.code} — {c.name} ({c.symbol})",
-            callback_data=f"currency:{c.code}"
+            text=f"{c['flag']} {c['code']} — {c['name']} ({c['symbol']})",
+            callback_data=f"currency:{c['code']}"
         )
         row.append(button)
         if i % 2 == 0:
@@ -289,9 +410,11 @@ def build_currency_inline_keyboard():
 def build_filter_markup(context) -> InlineKeyboardMarkup:
     lang = context.user_data.get("lang", "ru")
     filters = context.user_data.setdefault("filters", {})
-    passengers = filters.get("passengers", 1)
-    direct = filters.get("direct", None)
-    if direct is True:
+    return build_filter_keyboard(lang, filters.get("passengers", 1), filters.get("direct", None) is True)
+
+@cached_keyboard
+def build_filter_keyboard(lang, passengers, direct) -> InlineKeyboardMarkup:
+    if direct:
         direct_label = t("direct_flights_only", lang)
     else:
         direct_label = "✈️ ✅ " + t("include_transfers", lang)
@@ -308,7 +431,8 @@ def build_filter_markup(context) -> InlineKeyboardMarkup:
         ]
     ])
 
-def build_tracking_settings_keyboard(lang="ru", price=None, percent=None) -> InlineKeyboardMarkup:
+@cached_keyboard
+def _tracking_settings_keyboard(lang, price, percent) -> InlineKeyboardMarkup:
     price_label = t("track_set_price_val", lang, value=price) if price is not None else t("track_set_price", lang)
     percent_label = t("track_set_percent_val", lang, value=percent) if percent is not None else t("track_set_percent", lang)
     return InlineKeyboardMarkup([
@@ -321,3 +445,13 @@ def build_tracking_settings_keyboard(lang="ru", price=None, percent=None) -> Inl
             InlineKeyboardButton(t("track_cancel", lang), callback_data="track_cancel"),
         ]
     ])
+
+def build_tracking_settings_keyboard(lang="ru", price=None, percent=None) -> InlineKeyboardMarkup:
+    return _tracking_settings_keyboard(lang, price, percent)
+
+def warm_keyboards():
+    build_currency_inline_keyboard()
+    for lang in translations:
+        build_tracking_settings_keyboard(lang)
+        for direct in (False, True):
+            build_filter_keyboard(lang, 1, direct)